@@ -0,0 +1,53 @@
+# SPDX-License-Identifier: MIT
+import sys
+import time
+import statistics
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from circuitpy_helpers.calendar_time_helpers import timeHelper
+import pi_code
+
+# Micro-benchmark for the home hub calendar poll
+# "before" repeats what every poll used to do: read token.json and build the calendar service from scratch
+# "after" makes the same request with the long-lived credentials and calendar service kept by pi_code.py
+# Both sides make the same events().list call, so the difference is only the client set up
+# Run it from the home hub directory so .env, token.json and credentials.json are found
+# Usage: python calendar_benchmark.py [number of polls]
+
+polls = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+def list_events(service):
+    service.events().list(
+        calendarId=pi_code.calendar_id,
+        timeMin=timeHelper.get_unix_time(),
+        maxResults=2,
+        singleEvents=True,
+        orderBy="startTime",
+    ).execute()
+
+def poll_before():
+    creds = Credentials.from_authorized_user_file("token.json", pi_code.SCOPES)
+    list_events(build("calendar", "v3", credentials=creds))
+
+def poll_after():
+    pi_code.get_calendar_credentials()
+    list_events(pi_code.get_calendar_service())
+
+def time_polls(poll):
+    timings = []
+    for _ in range(polls):
+        started = time.perf_counter()
+        poll()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+def report(name, timings):
+    print(f"{name:<8} polls={len(timings)} min={min(timings):.1f}ms median={statistics.median(timings):.1f}ms max={max(timings):.1f}ms")
+
+# Make sure the token is valid before timing anything so neither side pays for a refresh
+pi_code.get_calendar_credentials()
+before = time_polls(poll_before)
+after = time_polls(poll_after)
+report("before", before)
+report("after", after)
+print(f"median speed up {statistics.median(before) / statistics.median(after):.1f}x")
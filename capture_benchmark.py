@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: MIT
+import sys
+import time
+import driveway_camera as cam
+
+# Benchmark for clip capture on the driveway camera
+# Starts the live stream, then records clips two ways and reports the CPU this process used and the
+# frames dropped from the camera feeding the live stream while each clip was recording
+#   busy: the old way, spinning on time.monotonic() until the clip should end
+#   timer: start_clip / finish_clip, where a timer stops the clip and the capturing thread just waits
+# Run it on the camera with the camera service stopped: python capture_benchmark.py [clips per mode]
+
+clips = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+frame_rate = cam.camera_profiles[cam.camera_profile]["framerate"]
+frame_interval = 1_000_000_000 / frame_rate
+
+# Sensor timestamps (ns) of every frame the camera delivers
+frame_times = []
+def record_frame(request):
+    frame_times.append(request.get_metadata()["SensorTimestamp"])
+
+# A gap of more than one and a half frame intervals means frames were dropped
+def count_dropped_frames():
+    dropped = 0
+    for previous, current in zip(frame_times, frame_times[1:]):
+        gap = current - previous
+        if gap > frame_interval * 1.5:
+            dropped += round(gap / frame_interval) - 1
+    return dropped
+
+def busy_clip(event):
+    cam.start_clip(event)
+    end_time = time.monotonic() + int(cam.capture_run_time)
+    while time.monotonic() < end_time:
+        pass
+    cam.stop_clip(event)
+
+def timer_clip(event):
+    cam.start_clip(event)
+    cam.finish_clip(event)
+
+def measure(name, clip):
+    for run in range(clips):
+        event = cam.new_motion_event()
+        frame_times.clear()
+        cpu_start = time.process_time()
+        wall_start = time.monotonic()
+        clip(event)
+        cpu = time.process_time() - cpu_start
+        wall = time.monotonic() - wall_start
+        print(f"{name:<6} clip {run + 1}: {wall:.1f}s cpu={cpu / wall * 100:.0f}% of a core "
+              f"frames={len(frame_times)} dropped={count_dropped_frames()}")
+        cam.remove_capture_files(event)
+        time.sleep(2)
+
+cam.picam.post_callback = record_frame
+cam.start_live_encoder()
+cam.picam.start()
+time.sleep(5)
+try:
+    measure("busy", busy_clip)
+    measure("timer", timer_clip)
+finally:
+    cam.picam.stop_encoder(cam.encoder)
+    cam.picam.stop()
@@ -1,21 +1,32 @@
 # SPDX-License-Identifier: MIT
 import base64
+import io
 import time
 import os
+import json
+import threading
+import queue
+import signal
+import bisect
+import hashlib
+import numpy as np
 import paramiko
 from paramiko.ssh_exception import AuthenticationException
-from scp import SCPClient
 import uuid
 from datetime import datetime
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
 import logging
 from libcamera import Transform
-from picamera2.outputs import PyavOutput, FfmpegOutput
+from picamera2.outputs import PyavOutput, CircularOutput2, FileOutput
 from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder, MJPEGEncoder
+from picamera2.encoders import H264Encoder
+from PIL import Image
+import requests
 import dropbox
-from dropbox.exceptions import AuthError
+from dropbox.exceptions import ApiError, AuthError, InternalServerError
+from dropbox.files import CommitInfo, FileMetadata, UploadSessionCursor, WriteMode
+from concurrent.futures import ThreadPoolExecutor
 
 # A RaspberryPi 4 based security camera
 # Using the RaspberryPi camera module 3 with noir and infrared LED light board
@@ -37,29 +48,56 @@ storage = "local"
 # --- Pi Camera Setup --- #
 tuning = Picamera2.load_tuning_file("/usr/share/libcamera/ipa/rpi/vc4/ov5647_noir.json")
 picam = Picamera2(tuning=tuning)
-# Video file name - use the same one and overwrite
-tmp_video = "temp_video"
-video_encoding = "mp4"
-filename = tmp_video + "." + video_encoding
+# Video file type, each motion event gets its own file name
+# Clips are the live stream's H.264 packets copied into an MP4 file without re-encoding,
+# set CLIP_FORMAT to h264 to keep the raw stream instead
+clip_format = os.getenv("CLIP_FORMAT", "mp4")
+video_encoding = clip_format
 # Configuration for video
-main = {'size': (1920, 1080), 'format': 'YUV420'}
-lores = {'size': (1920, 1080), 'format': 'YUV420'}
-capture = {'size': (1280, 720), 'format': 'YUV420'}
-fr_controls = ({'FrameRate': 30})
-# Live camera feed
-config = picam.create_video_configuration(main, controls=fr_controls, lores=lores, display="lores", transform=Transform(hflip=1, vflip=1))
-# Snap a picture on motion detect
-still_config = picam.create_still_configuration(main)
+# Named camera profiles, switch between them by publishing the name to the camera profile feed
+# main feeds the live stream, clips and stills, lores is a small copy of the same frames for analysis and previews
+#   live: full HD stream for everyday use
+#   capture: 720p, smaller clips and quicker uploads
+#   still: full HD at a lower frame rate, plus a still at the sensor's full resolution once each clip is recorded
+#   night: 720p at a lower frame rate so each frame can be exposed for longer
+# The hardware H.264 encoder stops at 1080p, so main can be no bigger than that
+camera_profiles = {
+    "live": {"main": (1920, 1080), "lores": (640, 360), "framerate": 30},
+    "capture": {"main": (1280, 720), "lores": (640, 360), "framerate": 30},
+    "still": {"main": (1920, 1080), "lores": (640, 360), "framerate": 15, "still": (2592, 1944)},
+    "night": {"main": (1280, 720), "lores": (320, 180), "framerate": 15},
+}
+camera_profile = os.getenv("CAMERA_PROFILE", "live")
+
+def create_camera_config(profile):
+    main = {'size': profile["main"], 'format': 'YUV420'}
+    lores = {'size': profile["lores"], 'format': 'YUV420'}
+    fr_controls = ({'FrameRate': profile["framerate"]})
+    return picam.create_video_configuration(main, controls=fr_controls, lores=lores, display="lores", transform=Transform(hflip=1, vflip=1))
+
+def create_still_config(size):
+    return picam.create_still_configuration({'size': size}, transform=Transform(hflip=1, vflip=1))
 
-picam.configure(config)
+picam.configure(create_camera_config(camera_profiles[camera_profile]))
 
 # Encoder and output configuration
-encoder = H264Encoder()
-encoder_capture = MJPEGEncoder()
+# The live stream also feeds a ring buffer holding the last few seconds of encoded video,
+# a clip starts with whatever is in the buffer so it includes the seconds before the motion was detected
+# A key frame every second (with the stream headers repeated) lets a clip start close to PRE_MOTION_SECONDS back
+pre_motion_seconds = int(os.getenv("PRE_MOTION_SECONDS", 5))
+encoder = H264Encoder(repeat=True, iperiod=camera_profiles[camera_profile]["framerate"])
 output_live = PyavOutput("rtsp:192.168.68.70:8554/cam", format="rtsp")
-output_capture = FfmpegOutput(filename)
-encoder.output = [output_live]
-encoder_capture.output = [output_capture]
+output_buffer = None
+
+# Start the encoder with a new ring buffer
+# CircularOutput2 adds another stream every time the encoder starts and keeps frames from the last run, whose
+# timestamps are ahead of the restarted encoder's, so a buffer is never reused across encoder restarts
+# Only call this when no clip is being recorded
+def start_live_encoder():
+    global output_buffer
+    output_buffer = CircularOutput2(buffer_duration_ms=pre_motion_seconds * 1000)
+    encoder.output = [output_live, output_buffer]
+    picam.start_encoder(encoder)
 
 # --- Logging set up --- #
 # Set the log level based on if we're testing or not
@@ -77,15 +115,44 @@ logger = logging.getLogger(__name__)
 ssh_username = os.getenv("FILE_SERVER_USERNAME")
 ssh_password = os.getenv("FILE_SERVER_PASSWORD")
 file_server_ip = os.getenv("FILE_SERVER_IP")
-logger.info("configuring SSH client")
-try:
+# One SSH connection and SFTP session to the file server is kept open and reused for every upload
+# It is checked before each use and reconnected if the server has gone away
+ssh_timeout = 10
+ssh_keepalive = 30
+ssh = None
+sftp = None
+ssh_lock = threading.Lock()
+transfer_stats = {"connects": 0, "files": 0, "bytes": 0, "seconds": 0.0}
+
+# Return the open SFTP session, connecting first if there isn't a healthy one
+def get_sftp():
+    global ssh, sftp
+    transport = ssh.get_transport() if ssh is not None else None
+    if sftp is not None and transport is not None and transport.is_active():
+        try:
+            transport.send_ignore()
+            return sftp
+        except (paramiko.SSHException, OSError, EOFError) as err:
+            logger.info("SSH connection to file server has gone away: %s", err)
+    close_sftp()
+    logger.info("connecting to file server")
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh_connected = True
-except AuthenticationException as auth_err:
-    logger.error("Authentication failed {}".format(auth_err))
-    ssh_connected = False
-    pass
+    try:
+        ssh.connect(file_server_ip, username=ssh_username, password=ssh_password, timeout=ssh_timeout)
+    except AuthenticationException as auth_err:
+        logger.error("Authentication failed {}".format(auth_err))
+        raise
+    ssh.get_transport().set_keepalive(ssh_keepalive)
+    sftp = ssh.open_sftp()
+    transfer_stats["connects"] += 1
+    return sftp
+
+def close_sftp():
+    global ssh, sftp
+    if ssh is not None:
+        ssh.close()
+    ssh, sftp = None, None
 
 # --- MQTT --- #
 # MQTT data for connecting
@@ -100,13 +167,14 @@ camera_feed = os.getenv('LOCAL_CAMERA_FEED')
 recording_feed = os.getenv('LOCAL_RECORDING_ON_FEED')
 
 # MQTT Subscribe feeds
-feeds_list=[]
+# Each feed has its own handler, registered further down with add_feed_handler
+feed_handlers = {}
 motion_feed = os.getenv('LOCAL_MOTION_FEED')
-feeds_list.append(motion_feed)
 storage_feed = os.getenv('LOCAL_STORAGE_FEED')
-feeds_list.append(storage_feed)
+profile_feed = os.getenv('LOCAL_CAMERA_PROFILE_FEED')
 
 # --- MQTT methods for handling traffic --- #
+# One client both publishes and subscribes, so there is a single TLS session and network thread
 # Set up MQTT client and connect to broker
 def connect_mqtt(cname):
     client_id = f'{cname}-mqtt-client-{uuid.getnode()}'
@@ -116,85 +184,221 @@ def connect_mqtt(cname):
     client.tls_set(ca_certs=ca_cert_file, certfile=client_pem, keyfile=None, keyfile_password=None)
     client.username_pw_set(client_username, client_password)
     client.on_connect = on_connect
+    client.on_connect_fail = on_connect_fail
     client.on_disconnect = on_disconnect
     client.on_message = on_message
-    if "sub" in client.client_id:
-        client.connect_async(mqtt_server, 8883, 60, clean_start=True)
-    else:
-        client.connect_async(mqtt_server, 8883, 60)
+    # A mistake in one of our callbacks is logged rather than taking down the network thread
+    client.enable_logger(logger)
+    client.suppress_exceptions = True
+    for feed, handler in feed_handlers.items():
+        client.message_callback_add(feed, handler)
+    client.connect_async(mqtt_server, 8883, 60, clean_start=True)
 
     return client
 
+# Register the handler for messages on a feed, the feed is subscribed to every time the client connects
+# Handlers take the same arguments as on_message
+def add_feed_handler(feed, handler):
+    feed_handlers[feed] = handler
+
 # What to do when the client connects
 def on_connect(client, userdata, flags, reason_code, properties):
-    global is_recording
+    global is_recording, disconnected_at
     logger.info(f"Connected to {client.client_id} MQTT Broker!")
-    if "sub" in client.client_id:
-        # Subscribe to any feeds
-        if feeds_list:
-            for feed in feeds_list:
-                client.subscribe(feed)
-                logger.info(f"subscribed sub_mqtt to {feed}")
-        else:
-            logger.info("there are no feeds in the list")
+    if disconnected_at is not None:
+        recovery = time.monotonic() - disconnected_at
+        reconnect_stats["attempts"] += 1
+        reconnect_stats["reconnects"] += 1
+        reconnect_stats["last_recovery"] = recovery
+        reconnect_stats["max_recovery"] = max(reconnect_stats["max_recovery"] or 0, recovery)
+        logger.info("Reconnected after %.1f seconds", recovery)
+        disconnected_at = None
+    # Subscribe to any feeds
+    if feed_handlers:
+        for feed in feed_handlers:
+            client.subscribe(feed)
+            logger.info(f"subscribed to {feed}")
+    else:
+        logger.info("there are no feeds in the list")
+    # Publishes can't wait for the broker from inside the network thread, so replay from a thread of our own
+    threading.Thread(target=replay_offline_publishes, daemon=True).start()
 
 # Auto reconnect logic
+# paho's network thread (loop_start) does all the socket work and reconnects by itself whenever the connection
+# is lost, backing off exponentially from FIRST_RECONNECT_DELAY up to MAX_RECONNECT_DELAY and never giving up,
+# so once the broker is back we are connected again within MAX_RECONNECT_DELAY seconds
+# Nothing else ever touches the socket, publish() just queues the message for that thread
 FIRST_RECONNECT_DELAY = 1
-RECONNECT_RATE = 2
-MAX_RECONNECT_COUNT = 12
 MAX_RECONNECT_DELAY = 60
-def on_disconnect(client, userdata, rc):
-    logger.info("Disconnected with result code: %s", rc)
-    reconnect_count, reconnect_delay = 0, FIRST_RECONNECT_DELAY
-    while reconnect_count < MAX_RECONNECT_COUNT:
-        logger.info("Reconnecting in %d seconds...", reconnect_delay)
-        time.sleep(reconnect_delay)
-        try:
-            client.reconnect()
-            logger.info("Reconnected successfully!")
-            return
-        except Exception as err:
-            logger.error("%s. Reconnect failed. Retrying...", err)
-        reconnect_delay *= RECONNECT_RATE
-        reconnect_delay = min(reconnect_delay, MAX_RECONNECT_DELAY)
-        reconnect_count += 1
-    logger.error("Reconnect failed after %s attempts. Exiting...", reconnect_count)
+reconnect_stats = {"disconnects": 0, "attempts": 0, "reconnects": 0, "last_recovery": None, "max_recovery": None}
+disconnected_at = None
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+    global disconnected_at
+    logger.info("Disconnected with result code: %s", reason_code)
+    reconnect_stats["disconnects"] += 1
+    if disconnected_at is None:
+        disconnected_at = time.monotonic()
+
+# A reconnect attempt failed, paho will try again after its back off
+def on_connect_fail(client, userdata):
+    reconnect_stats["attempts"] += 1
+    logger.debug("Reconnect failed, retrying")
+
+def start_mqtt_network_loop(client):
+    client.reconnect_delay_set(min_delay=FIRST_RECONNECT_DELAY, max_delay=MAX_RECONNECT_DELAY)
+    client.loop_start()
 
 # Subscribe method for MQTT
-# What to do when the subscriber gets a message
+# What to do when we get a message on a feed with no handler of its own
 def on_message(client, userdata, msg):
-    global storage
     received_msg = msg.payload.decode("utf-8")
     logger.debug("message payload is %s for topic %s", received_msg, msg.topic)
-    # Handle motion detection
-    if "motion" in msg.topic:
-        if "1" in received_msg:
-            logger.debug(f"{client.client_id} received message {received_msg} for topic {msg.topic}")
-            time.sleep(1)
-            start_recording()
-        else:
-            logger.debug(f"{client.client_id} received message {received_msg} for topic {msg.topic}")
-    # Handle storage assignment
-    if "storage" in msg.topic:
-        storage = received_msg
-        logger.debug(f"storage is now {received_msg}")
+
+# Handle motion detection
+# All we do here is queue the motion for the capture worker, so the network thread is never held up
+def on_motion_message(client, userdata, msg):
+    received_msg = msg.payload.decode("utf-8")
+    logger.debug(f"{client.client_id} received message {received_msg} for topic {msg.topic}")
+    if "1" in received_msg:
+        queue_motion()
+
+# Handle storage assignment
+def on_storage_message(client, userdata, msg):
+    global storage
+    received_msg = msg.payload.decode("utf-8")
+    storage = received_msg
+    logger.debug(f"storage is now {received_msg}")
+
+# Handle camera profile changes
+# Switching restarts the camera, which can take a moment, so do it away from the network thread
+def on_profile_message(client, userdata, msg):
+    received_msg = msg.payload.decode("utf-8").strip()
+    if received_msg not in camera_profiles:
+        logger.error(f"unknown camera profile {received_msg}")
+    elif received_msg != camera_profile:
+        threading.Thread(target=apply_camera_profile, args=(received_msg,), daemon=True).start()
+
+add_feed_handler(motion_feed, on_motion_message)
+add_feed_handler(storage_feed, on_storage_message)
+if profile_feed:
+    add_feed_handler(profile_feed, on_profile_message)
 
 # Publish to MQTT
 # Since subsequent publishes are done we need to ensure the publishes happen at the time of call
 # and that they are successful before proceeding
 # to do this we use the wait_for_publish method
+# If we are offline the latest message for each feed is held and sent when we reconnect,
+# the motion tasks carry on rather than waiting for the broker to come back
 # If the testing flag is enabled, print what would normally be published to MQTT
+publish_timeout = 10
+offline_publishes = {}
+offline_lock = threading.Lock()
 def do_publish(feed, data):
     if not testing:
+        if not mqtt_client.is_connected():
+            logger.info("offline, holding message for %s until we reconnect", feed)
+            with offline_lock:
+                offline_publishes[feed] = data
+            return "OFFLINE"
         logger.info("Publishing to %s", feed)
-        result = pub_mqtt.publish(feed, data)
-        result.wait_for_publish()
+        sent = time.monotonic()
+        result = mqtt_client.publish(feed, data)
+        try:
+            result.wait_for_publish(timeout=publish_timeout)
+        except (RuntimeError, ValueError) as err:
+            logger.error("publish to %s failed: %s", feed, err)
+        if not result.is_published():
+            logger.error("publish to %s was not sent within %d seconds, holding it until we reconnect", feed, publish_timeout)
+            telemetry_counters["publish_failures"] += 1
+            with offline_lock:
+                offline_publishes[feed] = data
+            return "OFFLINE"
+        observe(publish_latency, (time.monotonic() - sent) * 1000)
+        telemetry_counters["publishes"] += 1
         return result
     else:
         logger.debug("TESTING:")
         logger.debug("Would publish: Topic: %s. Payload: %s", str(feed), str(data))
         return "TESTING"
 
+# Send the messages held while we were offline
+def replay_offline_publishes():
+    with offline_lock:
+        messages = list(offline_publishes.items())
+        offline_publishes.clear()
+    if messages:
+        logger.info("replaying %d messages held while offline", len(messages))
+    for feed, data in messages:
+        do_publish(feed, data)
+
+# --- Telemetry --- #
+# Every telemetry_interval seconds a compact JSON summary is published to LOCAL_TELEMETRY_FEED/camera
+# for the hub to serve to Prometheus
+# Counters only ever go up, histograms count observations at or below each bound in le with one
+# more count at the end for anything above the last bound
+telemetry_feed = os.getenv('LOCAL_TELEMETRY_FEED')
+telemetry_interval = int(os.getenv("TELEMETRY_INTERVAL", 60))
+telemetry_lock = threading.Lock()
+telemetry_counters = {"publishes": 0, "publish_failures": 0, "captures": 0, "uploads": 0, "upload_failures": 0}
+started_at = time.monotonic()
+
+def new_histogram(bounds):
+    return {"le": bounds, "counts": [0] * (len(bounds) + 1), "sum": 0}
+
+def observe(histogram, value):
+    with telemetry_lock:
+        histogram["counts"][bisect.bisect_left(histogram["le"], value)] += 1
+        histogram["sum"] += value
+
+publish_latency = new_histogram([5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000])
+capture_time = new_histogram([0.25, 0.5, 1, 2, 5, 10])
+upload_time = {"local": new_histogram([1, 2, 5, 10, 30, 60, 120, 300]),
+               "remote": new_histogram([1, 2, 5, 10, 30, 60, 120, 300])}
+
+# Memory available to the whole Pi and held by this process, in bytes, from /proc
+# Empty where /proc isn't there to read
+def get_memory_gauges():
+    gauges = {}
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    gauges["mem_available_bytes"] = int(line.split()[1]) * 1024
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    gauges["process_resident_bytes"] = int(line.split()[1]) * 1024
+    except (OSError, ValueError) as err:
+        logger.debug(f"could not read memory use: {err}")
+    return gauges
+
+def get_telemetry():
+    counters = dict(telemetry_counters)
+    counters.update({f"motion_{name}": value for name, value in motion_stats.items()})
+    counters.update(watchdog_stats)
+    counters.update({f"mqtt_{name}": value for name, value in reconnect_stats.items() if name in ("disconnects", "attempts", "reconnects")})
+    counters.update({f"transfer_{name}": value for name, value in transfer_stats.items()})
+    with spool_lock:
+        spooled = len(spool_journal)
+    with telemetry_lock:
+        histograms = {"publish_latency_ms": dict(publish_latency, counts=list(publish_latency["counts"])),
+                      "capture_seconds": dict(capture_time, counts=list(capture_time["counts"]))}
+        for destination, histogram in upload_time.items():
+            histograms[f"upload_{destination}_seconds"] = dict(histogram, counts=list(histogram["counts"]))
+    gauges = {"uptime_seconds": round(time.monotonic() - started_at), "spool_captures": spooled}
+    gauges.update(get_memory_gauges())
+    return {"device": "camera",
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms}
+
+def telemetry_worker():
+    while not shutdown_event.wait(telemetry_interval):
+        try:
+            do_publish(f"{telemetry_feed}/camera", json.dumps(get_telemetry(), separators=(",", ":")))
+        except Exception as err:
+            logger.error("telemetry publish failed: %s", err)
+
 # --- General helpers --- #
 # Get the time from system clock and format it in human-readable formate
 def get_date_time():
@@ -203,6 +407,397 @@ def get_date_time():
     cur_date = now.strftime("%d%m%Y")
     return cur_date, cur_time
 
+# --- Motion pipeline --- #
+# Motion is handled by worker threads joined by bounded queues and the upload spool
+#   capture: start the clip, then tell the motion detectors we are recording and take a still
+#     the clip comes first so the ring buffer still holds the seconds before the motion while we publish
+#   encode: finish the clip after VIDEO_CAPTURE_TIME, free the camera for the next motion and spool the capture
+#   local and remote uploads: drain the spool to the file server and Dropbox, see Upload spool below
+# Each motion event gets its own file names, so a new event can be captured while the last one is still uploading
+# If motion arrives while a capture is already waiting it is dropped, the detectors re-trigger anyway
+motion_queue = queue.Queue(maxsize=1)
+encode_queue = queue.Queue(maxsize=1)
+# Only one clip can be recorded at a time, the capture stage takes this and the encode stage gives it back
+capture_slot = threading.Semaphore(1)
+
+def queue_motion():
+    if shutdown_event.is_set():
+        return
+    try:
+        motion_queue.put_nowait(time.monotonic())
+    except queue.Full:
+        logger.debug("motion already queued, ignoring")
+
+# Name the files for a motion event after when it happened, they are written straight into the spool
+tmp_video = "temp_video"
+image = "image"
+image_type = "jpg"
+def new_motion_event():
+    current_date, current_time = get_date_time()
+    event_id = f"{current_date}-{current_time}"
+    with spool_lock:
+        count = 1
+        while event_id in spool_journal:
+            count += 1
+            event_id = f"{current_date}-{current_time}-{count}"
+    return {"id": event_id,
+            "video": os.path.join(spool_dir, f"{tmp_video}_{event_id}.{video_encoding}"),
+            "image": os.path.join(spool_dir, f"{image}_{event_id}.{image_type}"),
+            "storage": storage}
+
+def capture_worker():
+    while True:
+        motion_at = motion_queue.get()
+        capture_slot.acquire()
+        if not confirm_motion():
+            logger.info("motion was not confirmed by the camera, not recording")
+            capture_slot.release()
+            continue
+        event = None
+        try:
+            event = new_motion_event()
+            start_clip(event)
+            observe(capture_time, time.monotonic() - motion_at)
+            if start_recording() and motion_detected(event):
+                telemetry_counters["captures"] += 1
+                encode_queue.put(event)
+                continue
+        except Exception as err:
+            logger.error("capture failed: %s", err)
+        abandon_capture(event)
+
+# Clean up after a capture that didn't make it to the encode worker
+# Whatever goes wrong here, the capture slot is always given back so the camera can record again
+def abandon_capture(event):
+    try:
+        if event is not None:
+            if "clip_done" in event:
+                stop_clip(event)
+            remove_capture_files(event)
+    except Exception as err:
+        logger.error("cleaning up the failed capture failed: %s", err)
+    finally:
+        capture_slot.release()
+        end_recording()
+
+def encode_worker():
+    while True:
+        event = encode_queue.get()
+        try:
+            finish_clip(event)
+            capture_full_still(event)
+            spool_capture(event)
+        except Exception as err:
+            logger.error("encode failed: %s", err)
+            remove_capture_files(event)
+        finally:
+            capture_slot.release()
+            end_recording()
+
+def start_motion_pipeline():
+    load_spool_journal()
+    for worker in (capture_worker, encode_worker, background_worker):
+        threading.Thread(target=worker, name=worker.__name__, daemon=True).start()
+    for destination in upload_destinations:
+        threading.Thread(target=upload_worker, args=(destination,), name=f"{destination}_upload", daemon=True).start()
+
+# --- Upload spool --- #
+# Finished captures wait in the spool directory until every destination has them
+# A small journal (journal.json) records which destinations each capture still needs, so nothing is lost
+# if an upload fails or the camera restarts
+# Each destination has its own worker, so with storage set to both the uploads run side by side
+# A failed upload is retried with back off, and if the spool (failed directory included) grows past
+# SPOOL_QUOTA_MB the captures that already failed are dropped first, oldest first, then the oldest captures
+# still waiting to be uploaded
+# After MAX_UPLOAD_ATTEMPTS failures a destination is given up on, and once nothing else needs the capture
+# its files are moved to the failed directory in the spool for someone to look at
+# Capture files that aren't in the journal at start up (from a crash before they were spooled) are adopted
+# if both the still and the clip are there and removed otherwise
+upload_destinations = ("local", "remote")
+spool_dir = os.getenv("SPOOL_DIR", os.path.join(os.getenv("LOCAL_FILE_LOCATION", "."), "spool"))
+spool_failed_dir = os.path.join(spool_dir, "failed")
+spool_journal_file = os.path.join(spool_dir, "journal.json")
+spool_quota = int(os.getenv("SPOOL_QUOTA_MB", 1024)) * 1024 * 1024
+max_upload_attempts = int(os.getenv("MAX_UPLOAD_ATTEMPTS", 10))
+FIRST_UPLOAD_RETRY_DELAY = 30
+MAX_UPLOAD_RETRY_DELAY = 3600
+spool_journal = {}
+spool_lock = threading.Condition()
+os.makedirs(spool_dir, exist_ok=True)
+
+# Where the storage setting says a capture should go
+def get_upload_destinations(storage_setting):
+    if "both" in storage_setting:
+        return ["local", "remote"]
+    return [destination for destination in upload_destinations if destination in storage_setting]
+
+# Write the journal to a temporary file and swap it in, so a crash never leaves half a journal
+# Call with spool_lock held
+def save_spool_journal():
+    temp_journal = spool_journal_file + ".tmp"
+    with open(temp_journal, "w") as journal:
+        json.dump(spool_journal, journal)
+    os.replace(temp_journal, spool_journal_file)
+
+# Pick up anything left in the spool from before a restart
+def load_spool_journal():
+    with spool_lock:
+        try:
+            if os.path.exists(spool_journal_file):
+                with open(spool_journal_file, "r") as journal:
+                    spool_journal.update(json.load(journal))
+        except ValueError as err:
+            logger.error("spool journal is unreadable, starting a new one: %s", err)
+        for event_id, entry in list(spool_journal.items()):
+            if not os.path.exists(entry["image"]) or not os.path.exists(entry["video"]):
+                logger.error(f"capture {event_id} is missing its files, dropping it from the spool")
+                del spool_journal[event_id]
+            else:
+                entry["next_attempt"] = {destination: 0 for destination in entry["pending"]}
+        adopt_spool_orphans()
+        enforce_spool_quota()
+        save_spool_journal()
+        if spool_journal:
+            logger.info(f"{len(spool_journal)} captures waiting in the spool from before the restart")
+
+# Journal capture files found in the spool that the journal doesn't know about, call with spool_lock held
+# Files are named by new_motion_event, a still and a clip with the same id are a capture
+def adopt_spool_orphans():
+    known_files = set()
+    for entry in spool_journal.values():
+        known_files.update((entry["image"], entry["video"]))
+    images = {}
+    videos = {}
+    for name in os.listdir(spool_dir):
+        capture_file = os.path.join(spool_dir, name)
+        if capture_file in known_files or not os.path.isfile(capture_file):
+            continue
+        if name.startswith(f"{image}_"):
+            images[os.path.splitext(name[len(image) + 1:])[0]] = capture_file
+        elif name.startswith(f"{tmp_video}_"):
+            videos[os.path.splitext(name[len(tmp_video) + 1:])[0]] = capture_file
+    for event_id in images.keys() & videos.keys():
+        logger.info(f"capture {event_id} was never spooled, adopting it")
+        event = {"id": event_id, "image": images.pop(event_id), "video": videos.pop(event_id), "storage": storage}
+        add_spool_entry(event, os.path.getmtime(event["image"]))
+    for capture_file in list(images.values()) + list(videos.values()):
+        logger.error(f"{capture_file} is only half a capture, removing it")
+        os.remove(capture_file)
+
+# Journal a capture for its destinations, call with spool_lock held
+def add_spool_entry(event, created):
+    destinations = get_upload_destinations(event["storage"])
+    spool_journal[event["id"]] = {"image": event["image"],
+                                  "video": event["video"],
+                                  "created": created,
+                                  "pending": destinations,
+                                  "attempts": {destination: 0 for destination in destinations},
+                                  "next_attempt": {destination: 0 for destination in destinations}}
+
+# Add a finished capture to the spool for the upload workers
+def spool_capture(event):
+    if not get_upload_destinations(event["storage"]):
+        logger.error(f"unknown storage {event['storage']}, not uploading capture {event['id']}")
+        remove_capture_files(event)
+        return
+    with spool_lock:
+        add_spool_entry(event, time.time())
+        enforce_spool_quota()
+        save_spool_journal()
+        spool_lock.notify_all()
+
+# Drop the oldest captures until the spool fits in its quota, call with spool_lock held
+def enforce_spool_quota():
+    def spool_size():
+        size = sum(os.path.getsize(failed_file) for failed_file in failed_files)
+        for entry in spool_journal.values():
+            for capture_file in (entry["image"], entry["video"]):
+                if os.path.exists(capture_file):
+                    size += os.path.getsize(capture_file)
+        return size
+    failed_files = []
+    if os.path.isdir(spool_failed_dir):
+        failed_files = [os.path.join(spool_failed_dir, name) for name in os.listdir(spool_failed_dir)]
+        failed_files = sorted((name for name in failed_files if os.path.isfile(name)), key=os.path.getmtime)
+    while failed_files and spool_size() > spool_quota:
+        failed_file = failed_files.pop(0)
+        logger.error(f"spool is over its quota, dropping {os.path.basename(failed_file)} from {spool_failed_dir}")
+        os.remove(failed_file)
+    while len(spool_journal) > 1 and spool_size() > spool_quota:
+        event_id = min(spool_journal, key=lambda key: spool_journal[key]["created"])
+        logger.error(f"spool is over its quota, dropping capture {event_id} before it was uploaded")
+        remove_capture_files(spool_journal.pop(event_id))
+
+# Upload captures to one destination, oldest first, for as long as the camera runs
+def upload_worker(destination):
+    copy_to_destination = copy_to_local_server if destination == "local" else copy_to_remote_server
+    while True:
+        with spool_lock:
+            event_id, wait = get_next_upload(destination)
+            while event_id is None:
+                spool_lock.wait(wait)
+                event_id, wait = get_next_upload(destination)
+            entry = spool_journal[event_id]
+            event = {"id": event_id, "image": entry["image"], "video": entry["video"]}
+        started = time.monotonic()
+        try:
+            uploaded = copy_to_destination(event)
+        except Exception as err:
+            logger.error(f"{destination} upload of {event_id} failed: {err}")
+            uploaded = False
+        if uploaded:
+            observe(upload_time[destination], time.monotonic() - started)
+            telemetry_counters["uploads"] += 1
+        else:
+            telemetry_counters["upload_failures"] += 1
+        finish_upload(destination, event_id, uploaded)
+
+# The oldest capture ready to go to a destination, or how long until one might be
+# Call with spool_lock held
+def get_next_upload(destination):
+    now = time.time()
+    wait = None
+    for event_id, entry in sorted(spool_journal.items(), key=lambda item: item[1]["created"]):
+        if destination not in entry["pending"]:
+            continue
+        next_attempt = entry["next_attempt"][destination]
+        if next_attempt <= now:
+            return event_id, None
+        if wait is None or next_attempt - now < wait:
+            wait = next_attempt - now
+    return None, wait
+
+# Record how an upload went, once every destination has a capture its files are removed
+def finish_upload(destination, event_id, uploaded):
+    with spool_lock:
+        entry = spool_journal.get(event_id)
+        if entry is None:
+            # Dropped to keep the spool under its quota while we were uploading
+            return
+        if uploaded:
+            entry["pending"].remove(destination)
+        else:
+            entry["attempts"][destination] += 1
+            if entry["attempts"][destination] >= max_upload_attempts:
+                logger.error(f"giving up on the {destination} upload of {event_id} after {max_upload_attempts} attempts")
+                entry["pending"].remove(destination)
+                entry.setdefault("failed", []).append(destination)
+            else:
+                retry_delay = min(FIRST_UPLOAD_RETRY_DELAY * 2 ** (entry["attempts"][destination] - 1), MAX_UPLOAD_RETRY_DELAY)
+                entry["next_attempt"][destination] = time.time() + retry_delay
+                logger.info(f"will retry the {destination} upload of {event_id} in {retry_delay} seconds")
+        if not entry["pending"]:
+            spool_journal.pop(event_id)
+            if entry.get("failed"):
+                move_to_failed(entry)
+            else:
+                remove_capture_files(entry)
+                logger.info(f"capture {event_id} has been uploaded everywhere")
+        save_spool_journal()
+
+# Keep the files of a capture that couldn't be uploaded out of the way of the spool
+def move_to_failed(entry):
+    os.makedirs(spool_failed_dir, exist_ok=True)
+    for capture_file in (entry["image"], entry["video"]):
+        if os.path.exists(capture_file):
+            os.replace(capture_file, os.path.join(spool_failed_dir, os.path.basename(capture_file)))
+    logger.error(f"moved {os.path.basename(entry['video'])} to {spool_failed_dir}, it was not uploaded to {entry['failed']}")
+
+# --- Motion confirmation --- #
+# The PIR also trips on heat and sunlight, so before recording check the camera can see something moving
+# A background model of the lores luma is kept up to date from one lores frame every BACKGROUND_INTERVAL
+# seconds, a small copy of the 640x360 luma and a blend into the model each time
+# Raise BACKGROUND_INTERVAL to spend less CPU while idle, at the cost of a model that is slower to follow
+# changes in the light
+# When the PIR trips, lores frames are compared against it for up to MOTION_CONFIRM_TIME seconds and motion is
+# confirmed as soon as enough of the watched pixels differ from the background by more than the threshold
+# MOTION_MASK_FILE is an optional .npy array of booleans the size of the lores stream, True where motion counts
+# Set MOTION_CONFIRM to 0 to record on every PIR trigger
+motion_confirm = os.getenv("MOTION_CONFIRM", "1") == "1"
+motion_confirm_time = float(os.getenv("MOTION_CONFIRM_TIME", 0.5))
+motion_pixel_threshold = int(os.getenv("MOTION_PIXEL_THRESHOLD", 25))
+motion_min_fraction = float(os.getenv("MOTION_MIN_FRACTION", 0.01))
+motion_mask_file = os.getenv("MOTION_MASK_FILE")
+motion_mask = np.load(motion_mask_file).astype(bool) if motion_mask_file else None
+background_interval = float(os.getenv("BACKGROUND_INTERVAL", 1))
+background_rate = 0.05
+background = None
+background_lock = threading.Lock()
+motion_stats = {"confirmed": 0, "rejected": 0}
+
+# The luma (Y) plane of the next lores frame, the colour planes follow it in the YUV420 array
+def get_lores_luma():
+    width, height = camera_profiles[camera_profile]["lores"]
+    frame = picam.capture_array("lores")
+    return frame[:height, :width].astype(np.float32)
+
+# Keep a slowly moving average of the scene so changes in light over the day aren't seen as motion
+def background_worker():
+    global background
+    while not shutdown_event.is_set():
+        try:
+            luma = get_lores_luma()
+            with background_lock:
+                if background is None or background.shape != luma.shape:
+                    background = luma
+                else:
+                    background += background_rate * (luma - background)
+        except Exception as err:
+            logger.error("background model update failed: %s", err)
+        shutdown_event.wait(background_interval)
+
+# Returns True if the camera sees motion, or if it can't tell (no background yet, or an error)
+def confirm_motion():
+    if not motion_confirm:
+        return True
+    with background_lock:
+        reference = None if background is None else background.copy()
+    if reference is None:
+        return True
+    mask = motion_mask if motion_mask is not None and motion_mask.shape == reference.shape else None
+    watched = reference.size if mask is None else np.count_nonzero(mask)
+    deadline = time.monotonic() + motion_confirm_time
+    try:
+        while True:
+            luma = get_lores_luma()
+            if luma.shape != reference.shape:
+                return True
+            changed = np.abs(luma - reference) > motion_pixel_threshold
+            if mask is not None:
+                changed &= mask
+            fraction = np.count_nonzero(changed) / max(watched, 1)
+            if fraction >= motion_min_fraction:
+                logger.debug("motion confirmed, %.1f%% of the scene changed", fraction * 100)
+                motion_stats["confirmed"] += 1
+                return True
+            if time.monotonic() >= deadline:
+                motion_stats["rejected"] += 1
+                return False
+    except Exception as err:
+        logger.error("motion confirmation failed, recording anyway: %s", err)
+        return True
+
+# Reconfigure the camera for a new profile
+# Waits for any clip being recorded to finish, then restarts the camera and live stream with the new settings
+def apply_camera_profile(name):
+    global camera_profile
+    with capture_slot:
+        logger.info(f"switching camera profile from {camera_profile} to {name}")
+        # Keep a key frame every second at the new frame rate
+        encoder.iperiod = camera_profiles[name]["framerate"]
+        restart_camera(create_camera_config(camera_profiles[name]))
+        camera_profile = name
+
+# Stop and start the camera and live stream, optionally with a new configuration
+# Call with capture_slot held so no clip is being recorded
+def restart_camera(config=None):
+    picam.stop_encoder(encoder)
+    picam.stop()
+    if config is not None:
+        picam.configure(config)
+    start_live_encoder()
+    picam.start()
+
 # Let motion detectors know recording is in progress
 is_recording = 0
 def start_recording():
@@ -212,69 +807,132 @@ def start_recording():
     result = do_publish(recording_feed, 1)
     if result:
         logger.info("start recording finished, calling next task")
-        motion_detected()
-    else:
-        logger.error("start recording failed, not proceeding")
+        return True
+    logger.error("start recording failed, not proceeding")
+    return False
 
-# When motion is detected, capture and image, base64 encode it, and send to MQTT
-# Upon success, call capture_clip to grab a portion of the live feed and save it to a file
-image = "image"
-image_type = "jpg"
-image_filename = f'{image}.{image_type}'
-def motion_detected():
+# When motion is detected, capture an image and send a thumbnail of it to MQTT
+# The still is captured to memory and written to disk once for the uploads, the thumbnail never touches the SD card
+# The thumbnail is published as raw JPEG bytes, set CAMERA_FEED_BASE64 to 1 for subscribers expecting base64 text
+still_quality = int(os.getenv("STILL_JPEG_QUALITY", 90))
+thumbnail_quality = int(os.getenv("THUMBNAIL_JPEG_QUALITY", 75))
+thumbnail_size = tuple(int(size) for size in os.getenv("THUMBNAIL_SIZE", "640x360").split("x"))
+camera_feed_base64 = os.getenv("CAMERA_FEED_BASE64", "0") == "1"
+picam.options["quality"] = still_quality
+def motion_detected(event):
     logger.info("motion detected has been called")
-    picam.capture_file(image_filename,  format='jpeg')
-    with open(image_filename,  mode='rb') as file:
-        base64_bytes = base64.b64encode(file.read())
-        base64_message = base64_bytes.decode("utf-8")
-    file.close()
-    result = do_publish(camera_feed, base64_message)
+    still = io.BytesIO()
+    picam.capture_file(still, format='jpeg')
+    with open(event["image"], mode='wb') as file:
+        file.write(still.getbuffer())
+    still.seek(0)
+    thumbnail_image = Image.open(still)
+    thumbnail_image.thumbnail(thumbnail_size)
+    thumbnail = io.BytesIO()
+    thumbnail_image.save(thumbnail, format='JPEG', quality=thumbnail_quality)
+    message = thumbnail.getvalue()
+    if camera_feed_base64:
+        message = base64.b64encode(message).decode("utf-8")
+    result = do_publish(camera_feed, message)
     if result:
         logger.info("motion detected finished, calling next task")
-        capture_clip()
-    else:
-        logger.error("motion detected failed, not proceeding")
+        return True
+    logger.error("motion detected failed, not proceeding")
+    return False
+
+# Profiles with a still size replace the motion still with one at that size once the clip is recorded
+# The camera has to switch to a still configuration for it, which means pausing the live stream for a moment,
+# so it is only done with capture_slot held and no clip recording
+# If it fails the still from the live stream is kept
+def capture_full_still(event):
+    size = camera_profiles[camera_profile].get("still")
+    if size is None:
+        return
+    logger.info(f"capturing a {size[0]}x{size[1]} still")
+    picam.stop_encoder(encoder)
+    try:
+        picam.switch_mode_and_capture_file(create_still_config(size), event["image"], format="jpeg")
+    except Exception as err:
+        logger.error("full resolution still failed, keeping the live stream still: %s", err)
+    finally:
+        start_live_encoder()
 
 # Capture a portion of the live feed to save to a file
-# By default only send to local fileserver
-# Use MQTT to publish whether that should be remote or both
-# MQTT feed: monitoring.storage
+# The clip is written from the live stream's ring buffer, so it starts PRE_MOTION_SECONDS before the motion
+# and no second encoder is needed
+# A timer stops the clip after VIDEO_CAPTURE_TIME seconds and signals clip_done,
+# so nothing has to sit and watch the clock while the clip is recording
 capture_run_time = os.getenv("VIDEO_CAPTURE_TIME")
-def capture_clip():
-    global is_recording
+# If the clip can't be opened the event is left marked done, so stop_clip has nothing to do
+def start_clip(event):
     logger.info("capture clip has been called")
-    record = True
-    end_time = time.monotonic() + int(capture_run_time)
-    picam.start_encoder(encoder_capture)
-    while record:
-        if time.monotonic() > end_time:
-            output_capture.stop()
-            picam.stop_encoder(encoder_capture)
-            record = False
+    event["clip_done"] = threading.Event()
+    event["clip_lock"] = threading.Lock()
+    event["clip_timer"] = threading.Timer(int(capture_run_time), stop_clip, args=(event,))
+    try:
+        event["output"] = get_clip_output(event["video"])
+        output_buffer.open_output(event["output"])
+    except Exception:
+        event["clip_done"].set()
+        raise
+    event["clip_timer"].start()
+
+# Where the clip's packets go, either muxed into an MP4 or written out as they are
+def get_clip_output(clip_file):
+    if clip_format == "mp4":
+        return PyavOutput(clip_file, format="mp4")
+    return FileOutput(clip_file)
+
+# Stop the clip, safe to call more than once and from any thread
+def stop_clip(event):
+    with event["clip_lock"]:
+        if event["clip_done"].is_set():
+            return
+        event["clip_timer"].cancel()
+        try:
+            output_buffer.close_output()
+        finally:
+            event["clip_done"].set()
+
+# Wait for the clip to be finished, if the timer has somehow not fired stop it ourselves
+def finish_clip(event):
+    if not event["clip_done"].wait(int(capture_run_time) + 10):
+        logger.error("capture clip timer did not fire, stopping the clip")
+        stop_clip(event)
     logger.info("capture clip finished, calling next task")
-    if "local" in storage:
-        copy_to_local_server()
-    if "remote" in storage:
-        copy_to_remote_server()
-    if "both" in storage:
-        copy_to_local_server()
-        time.sleep(2)
-        copy_to_remote_server()
+
+# The capture files are only needed until they have been uploaded
+def remove_capture_files(event):
+    for capture_file in (event["image"], event["video"]):
+        try:
+            os.remove(capture_file)
+        except FileNotFoundError:
+            pass
+
+# Let subscribers know recording is complete and any new motion can be detected
+def end_recording():
+    global is_recording
+    is_recording = 0
+    result = do_publish(recording_feed, 0)
+    if result:
+        logger.info("All motion detected tasks complete")
+    else:
+        logger.error("All motion detected tasks did not complete")
 
 # --- Copy to local and or remote fileservers --- #
 
 # Set the paths for the local and remote files and rename remote files for storage
-def name_files_to_copy(caller):
-    current_date, current_time = get_date_time()
-    local_file_location = os.getenv("LOCAL_FILE_LOCATION")
+# The capture files are already in the spool, so only the destination names need working out
+def name_files_to_copy(caller, event):
     local_file_storage_path = os.getenv("LOCAL_STORAGE_PATH")
     remote_file_storage_path = os.getenv("REMOTE_STORAGE_PATH")
-    local_video_file = local_file_location + "/" + filename
-    local_image_file = local_file_location + "/" + image_filename
-    remote_video_file = remote_file_storage_path + "/" + "video_capture_" + current_date + "-" + current_time + "." + video_encoding
-    remote_image_file = remote_file_storage_path + "/" + "image_" + current_date + "-" + current_time + image_type
-    local_storage_video = local_file_storage_path + "/" + "video_capture_" + current_date + "-" + current_time + "." + video_encoding
-    local_storage_image = local_file_storage_path + "/" + "image_" + current_date + "-" + current_time + image_type
+    local_video_file = event["video"]
+    local_image_file = event["image"]
+    video_extension = os.path.splitext(local_video_file)[1]
+    remote_video_file = remote_file_storage_path + "/" + "video_capture_" + event["id"] + video_extension
+    remote_image_file = remote_file_storage_path + "/" + "image_" + event["id"] + "." + image_type
+    local_storage_video = local_file_storage_path + "/" + "video_capture_" + event["id"] + video_extension
+    local_storage_image = local_file_storage_path + "/" + "image_" + event["id"] + "." + image_type
 
     if caller == "local":
         return local_video_file, local_image_file, local_storage_video, local_storage_image
@@ -284,113 +942,276 @@ def name_files_to_copy(caller):
         return None
 
 # Copy files to local file server
-def copy_to_local_server():
-    global ssh_connected
+# Files are sent over the shared SFTP session with pipelined writes, if the session fails part way
+# it is reconnected and the copy tried once more
+def copy_to_local_server(event):
     logger.info("copy video to local server has been called")
-    files = name_files_to_copy("local")
+    files = name_files_to_copy("local", event)
     local_video, local_image, remote_video, remote_image = files
-    if ssh_connected:
-        try:
-            ssh.connect(file_server_ip, username=ssh_username, password=ssh_password)
-            scp = SCPClient(ssh.get_transport())
-            scp.put(local_video, remote_video)
-            scp.put(local_image, remote_image)
-            logger.info("successfully copied video and still shot to local server!")
-        except Exception as err:
-            logger.error("failed to copy video to local server! %s", err)
-        finally:
-            ssh.close()
-    else:
-        logger.error("SSH connection not active, not attempting to copy to local server!")
+    with ssh_lock:
+        for attempt in range(2):
+            try:
+                client = get_sftp()
+                for local_file, remote_file in ((local_video, remote_video), (local_image, remote_image)):
+                    started = time.monotonic()
+                    size = client.put(local_file, remote_file).st_size
+                    record_transfer(size, time.monotonic() - started)
+                logger.info("successfully copied video and still shot to local server!")
+                return True
+            except (paramiko.SSHException, OSError, EOFError) as err:
+                logger.error("failed to copy video to local server! %s", err)
+                close_sftp()
+    return False
 
-    end_recording("local")
+# Keep running totals for the file server uploads and log the speed of each one
+def record_transfer(size, seconds):
+    transfer_stats["files"] += 1
+    transfer_stats["bytes"] += size
+    transfer_stats["seconds"] += seconds
+    logger.info("copied %d bytes in %.2f seconds (%.0f KB/s)", size, seconds, size / 1024 / max(seconds, 0.001))
 
 # Copy to Dropbox, the remote file service
-proceed = False
+# One authenticated client is kept for the life of the camera, the SDK refreshes its access token when it needs to
+# Files are streamed through upload sessions in fixed size chunks, so memory use doesn't grow with the clip
+# and there is no single upload size limit
+# When a chunk fails it is retried from the offset Dropbox says it has, so the upload resumes rather than restarts
+# If the reply to the final commit is lost the session is closed when we retry, so check whether Dropbox
+# already has the file with the same content hash before giving up
+# Each capture has its own remote names, so a spool retry of the whole upload just overwrites what is there
+# The still and the clip are uploaded at the same time
 access_token = os.getenv("DROPBOX_ACCESS_TOKEN")
 refresh_token = os.getenv("DROPBOX_REFRESH_TOKEN")
 app_key = os.getenv("DROPBOX_APP_KEY")
 app_secret = os.getenv("DROPBOX_APP_SECRET")
-def copy_to_remote_server():
-    global proceed
+dropbox_chunk_size = 4 * 1024 * 1024
+dropbox_retries = 5
+dbx = None
+dbx_lock = threading.Lock()
+
+def get_dropbox():
+    global dbx
+    with dbx_lock:
+        if dbx is None:
+            dbx = dropbox.Dropbox(
+                app_key=app_key,
+                app_secret=app_secret,
+                oauth2_refresh_token=refresh_token
+            )
+        return dbx
+
+def reset_dropbox():
+    global dbx
+    with dbx_lock:
+        dbx = None
+
+def copy_to_remote_server(event):
     logger.info("copy to remote server has been called")
-    files = name_files_to_copy("remote")
+    files = name_files_to_copy("remote", event)
     local_video, local_image, remote_video, remote_image = files
-    dbx = None
-    # Try to connect with access and refresh tokens, report if failure but allow application to continue
+    # Report if failure but let application continue
     try:
-        dbx = dropbox.Dropbox(
-            app_key=app_key,
-            app_secret=app_secret,
-            oauth2_refresh_token=refresh_token
-        )
-        logger.info("successfully authenticated with Dropbox")
-        proceed = True
+        client = get_dropbox()
+        with ThreadPoolExecutor(max_workers=2) as uploads:
+            image_upload = uploads.submit(upload_to_dropbox, client, local_image, remote_image)
+            video_upload = uploads.submit(upload_to_dropbox, client, local_video, remote_video)
+            image_upload.result()
+            video_upload.result()
+        logger.info("uploaded still and video capture to remote server")
+        return True
     except AuthError as err:
-        print("Error connecting to Dropbox with access token: {}".format(err))
-        pass
-    # If successfully connect, publish still and video to Dropbox
-    if proceed:
-        # Create valid image file for upload
-        with open(local_image, 'rb') as still:
-            image_upload_file = still.read()
-        still.close()
-        # Create valid video file for upload
-        with open(local_video, 'rb') as video:
-            video_upload_file = video.read()
-        video.close()
-        # Attempt to upload to Dropbox, report if failure but let application to continue
+        logger.error("Error connecting to Dropbox with access token: {}".format(err))
+        reset_dropbox()
+    except Exception as err:
+        logger.error("Error uploading still and video capture files: {}".format(err))
+    return False
+
+# Upload one file through an upload session, a chunk at a time
+def upload_to_dropbox(client, local_file, remote_file):
+    size = os.path.getsize(local_file)
+    started = time.monotonic()
+    session = with_dropbox_retries(lambda: client.files_upload_session_start(b""))
+    cursor = UploadSessionCursor(session_id=session.session_id, offset=0)
+    commit = CommitInfo(path=remote_file, mode=WriteMode.overwrite)
+    finishing = False
+    failures = 0
+    with open(local_file, 'rb') as upload_file:
+        while True:
+            upload_file.seek(cursor.offset)
+            chunk = upload_file.read(dropbox_chunk_size)
+            try:
+                if cursor.offset + len(chunk) >= size:
+                    finishing = True
+                    client.files_upload_session_finish(chunk, cursor, commit)
+                    break
+                client.files_upload_session_append_v2(chunk, cursor)
+                cursor.offset += len(chunk)
+                failures = 0
+            except ApiError as err:
+                correct_offset = get_correct_offset(err.error)
+                if correct_offset is None:
+                    if finishing and dropbox_has_file(client, local_file, remote_file):
+                        logger.info("Dropbox already has %s, the last commit went through", remote_file)
+                        break
+                    raise
+                logger.info("Dropbox has %d bytes of %s, resuming from there", correct_offset, remote_file)
+                cursor.offset = correct_offset
+            except (requests.exceptions.RequestException, InternalServerError) as err:
+                failures += 1
+                if failures > dropbox_retries:
+                    raise
+                logger.error("Dropbox upload of %s interrupted, retrying: %s", remote_file, err)
+                time.sleep(2 ** failures)
+    seconds = time.monotonic() - started
+    logger.info("uploaded %d bytes to Dropbox in %.2f seconds", size, seconds)
+
+# Retry a single Dropbox call on network errors
+def with_dropbox_retries(call):
+    for attempt in range(dropbox_retries):
+        try:
+            return call()
+        except (requests.exceptions.RequestException, InternalServerError) as err:
+            logger.error("Dropbox request failed, retrying: %s", err)
+            time.sleep(2 ** (attempt + 1))
+    return call()
+
+# True if Dropbox has remote_file with the same content as local_file
+def dropbox_has_file(client, local_file, remote_file):
+    try:
+        metadata = client.files_get_metadata(remote_file)
+    except ApiError:
+        return False
+    return isinstance(metadata, FileMetadata) and metadata.content_hash == get_dropbox_content_hash(local_file)
+
+# Dropbox's content hash: the SHA-256 of the SHA-256 of each 4 MB block of the file
+def get_dropbox_content_hash(local_file):
+    block_hashes = b""
+    with open(local_file, 'rb') as hash_file:
+        while True:
+            block = hash_file.read(4 * 1024 * 1024)
+            if not block:
+                break
+            block_hashes += hashlib.sha256(block).digest()
+    return hashlib.sha256(block_hashes).hexdigest()
+
+# If Dropbox rejected a chunk because it already has more (or less) of the file, the offset it actually has
+def get_correct_offset(error):
+    if hasattr(error, "is_lookup_failed") and error.is_lookup_failed():
+        error = error.get_lookup_failed()
+    if hasattr(error, "is_incorrect_offset") and error.is_incorrect_offset():
+        return error.get_incorrect_offset().correct_offset
+    return None
+
+# --- Supervisor --- #
+# The main thread sleeps until SIGTERM or SIGINT sets shutdown_event, everything else runs in its own thread
+# A watchdog wakes every WATCHDOG_INTERVAL seconds to check the camera is still delivering frames,
+# the encoder and live stream are running and MQTT is connected, and restarts whatever isn't
+# Apart from the watchdog, the only regular work between motions is the background model for motion
+# confirmation, which grabs one lores frame every BACKGROUND_INTERVAL seconds (see Motion confirmation)
+shutdown_event = threading.Event()
+watchdog_interval = int(os.getenv("WATCHDOG_INTERVAL", 30))
+frame_stall_time = int(os.getenv("FRAME_STALL_TIME", 10))
+mqtt_stall_time = int(os.getenv("MQTT_STALL_TIME", 300))
+watchdog_stats = {"camera_restarts": 0, "encoder_restarts": 0, "mqtt_restarts": 0}
+last_frame_time = None
+live_stream_error = None
+mqtt_restarted_at = None
+
+# Called by picamera2 after every frame, just note the time so the watchdog can tell frames are arriving
+def note_frame(request):
+    global last_frame_time
+    last_frame_time = time.monotonic()
+
+# Called by the RTSP output when it can't send to the stream server, the watchdog restarts the encoder
+def on_live_stream_error(err):
+    global live_stream_error
+    logger.error("live stream failed: %s", err)
+    live_stream_error = err
+
+picam.post_callback = note_frame
+output_live.error_callback = on_live_stream_error
+
+def watchdog_worker():
+    while not shutdown_event.wait(watchdog_interval):
         try:
-            dbx.files_upload(image_upload_file, remote_image)
-            time.sleep(2)
-            dbx.files_upload(video_upload_file, remote_video)
+            check_camera()
         except Exception as err:
-            logger.error("Error uploading still and video capture files: {}".format(err))
-            pass
-        finally:
-            logger.info("uploaded still and video capture to remote server")
-
-    end_recording("remote")
-
-def end_recording(caller):
-    # Let subscribers know recording is complete and any new motion can be detected
-    if storage == "both":
-        if caller == "remote":
-            logger.info(f"Publishing to {storage} per {caller}")
-            result = do_publish(recording_feed, 0)
-            if result:
-                logger.info("All motion detected tasks complete")
-            else:
-                logger.error("All motion detected tasks did not complete")
-    else:
-        logger.info(f"Publishing to {storage} per {caller}")
-        result = do_publish(recording_feed, 0)
-        if result:
-            logger.info("All motion detected tasks complete")
-        else:
-            logger.error("All motion detected tasks did not complete")
+            logger.error("watchdog could not restart the camera: %s", err)
+        try:
+            check_mqtt()
+        except Exception as err:
+            logger.error("watchdog could not restart MQTT: %s", err)
 
-# --- Pre-launch steps --- #
-# Connect to MQTT for publish and subscribe
-logger.info("Connecting publish MQTT client")
-pub_mqtt = connect_mqtt("pub")
-logger.info("Connecting subscribe MQTT client")
-sub_mqtt = connect_mqtt("sub")
-
-# Start camera live feed
-logger.info("Camera starting")
-picam.start_encoder(encoder)
-picam.start()
-time.sleep(5)
-
-# --- Launch --- #
-while True:
+def check_camera():
+    global live_stream_error
+    # A clip being recorded means the camera and encoder are busy and fine, check again next time
+    if not capture_slot.acquire(blocking=False):
+        return
     try:
-        # Ensure the clients are active
-        pub_mqtt.loop_start()
-        sub_mqtt.loop_start()
-        time.sleep(0.25)
-    except KeyboardInterrupt:
-        # If receive keyboard interrupt, stop camera
-        picam.stop()
-        logger.info("Camera stopped")
\ No newline at end of file
+        if last_frame_time is None or time.monotonic() - last_frame_time > frame_stall_time:
+            logger.error("no frames from the camera, restarting it")
+            watchdog_stats["camera_restarts"] += 1
+            restart_camera()
+        elif not encoder.running or live_stream_error is not None:
+            logger.error("encoder or live stream has stopped, restarting the encoder")
+            watchdog_stats["encoder_restarts"] += 1
+            live_stream_error = None
+            picam.stop_encoder(encoder)
+            start_live_encoder()
+    finally:
+        capture_slot.release()
+
+# paho keeps trying to reconnect by itself, if that hasn't worked for a long while start its network
+# thread again in case it has got stuck, at most once every mqtt_stall_time seconds
+# This doesn't touch the camera, so it is checked even while a clip is being recorded
+def check_mqtt():
+    global mqtt_restarted_at
+    now = time.monotonic()
+    if disconnected_at is not None and now - disconnected_at > mqtt_stall_time and \
+            (mqtt_restarted_at is None or now - mqtt_restarted_at > mqtt_stall_time):
+        logger.error(f"MQTT has been disconnected for over {mqtt_stall_time} seconds, restarting its network thread, reconnect stats {reconnect_stats}")
+        watchdog_stats["mqtt_restarts"] += 1
+        mqtt_restarted_at = now
+        mqtt_client.loop_stop()
+        start_mqtt_network_loop(mqtt_client)
+
+def request_shutdown(signum, frame):
+    logger.info(f"received {signal.Signals(signum).name}, shutting down")
+    shutdown_event.set()
+
+# Let any clip being recorded finish, then stop the camera and say goodbye to the broker
+# Captures still waiting to upload are in the spool journal and are picked up on the next start
+def shutdown_camera():
+    if not capture_slot.acquire(timeout=int(capture_run_time) + 15):
+        logger.error("clip did not finish in time, stopping the camera anyway")
+    picam.stop_encoder(encoder)
+    picam.stop()
+    picam.close()
+    logger.info("Camera stopped")
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+    logger.info("MQTT disconnected")
+
+# --- Pre-launch steps --- #
+# Only when run as the camera, so the capture benchmark can import the set up above
+if __name__ == "__main__":
+    # Connect to MQTT for publish and subscribe
+    logger.info("Connecting MQTT client")
+    mqtt_client = connect_mqtt("camera")
+    start_mqtt_network_loop(mqtt_client)
+
+    # Start the motion capture and upload workers
+    start_motion_pipeline()
+
+    # Start camera live feed
+    logger.info("Camera starting")
+    start_live_encoder()
+    picam.start()
+
+    # --- Launch --- #
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    threading.Thread(target=watchdog_worker, name="watchdog", daemon=True).start()
+    if telemetry_feed:
+        threading.Thread(target=telemetry_worker, name="telemetry", daemon=True).start()
+    shutdown_event.wait()
+    shutdown_camera()
@@ -1,11 +1,14 @@
 # SPDX-License-Identifier: MIT
 import os
+import gc
+import json
 import time
+import alarm
 import alarm.pin
+import alarm.time
 import board
 import digitalio
 import wifi
-from adafruit_debouncer import Debouncer
 import adafruit_minimqtt.adafruit_minimqtt
 from adafruit_minimqtt.adafruit_minimqtt import MMQTTException
 import adafruit_connection_manager
@@ -49,6 +52,7 @@ def on_disconnect(mqtt_client, userdata, rc):
     # This method is called when the mqtt_client disconnects
     # from the broker.
     logger.info(f"{mqtt_client} Disconnected from MQTT Broker!")
+    telemetry_counters["disconnects"] += 1
     counter = 0
     while counter <= 10:
         try:
@@ -82,6 +86,7 @@ mqtt_local_key = os.getenv("mqtt_local_key_motion")
 
 # Feeds for garage door sensor
 garage_door_feed = os.getenv("garage_sensor_local_feed")
+telemetry_feed = os.getenv("telemetry_local_feed")
 
 my_mqtt = adafruit_minimqtt.adafruit_minimqtt.MQTT(
     broker=mqtt_local_broker
@@ -99,70 +104,171 @@ my_mqtt.on_disconnect = on_disconnect
 my_mqtt.on_subscribe = on_subscribe
 
 # --- Garage Door Sensor --- #
+# The pin has to be released before it can be used as a wake alarm, so it is only held long enough to read it
+# The reed switch pulls the pin low when closed and needs an external pull up resistor (10k from A3 to 3.3V)
+# to wake the board when the door opens, see the sleep at the bottom for why the internal pull up isn't enough
+# Reading the pin uses the internal pull up, so a sensor without the resistor still reads the door correctly
+# and falls back on polling while the door is closed (see closed_poll_wait)
+# The reed switch bounces as the door moves, so the state only counts once debounce_samples readings
+# debounce_interval seconds apart agree, giving up after debounce_timeout seconds with the last reading
 sensor_pin = board.A3
+debounce_samples = 5
+debounce_interval = 0.01
+debounce_timeout = 1
 
-def set_up_sensor():
+def read_door_state():
     garage_door_sensor = digitalio.DigitalInOut(sensor_pin)
     garage_door_sensor.direction = digitalio.Direction.INPUT
     garage_door_sensor.pull = digitalio.Pull.UP
-    garage_door_switch = Debouncer(garage_door_sensor)
+    give_up = time.monotonic() + debounce_timeout
+    status = garage_door_sensor.value
+    stable = 1
+    while stable < debounce_samples and time.monotonic() < give_up:
+        time.sleep(debounce_interval)
+        reading = garage_door_sensor.value
+        if reading == status:
+            stable += 1
+        else:
+            status = reading
+            stable = 1
+    garage_door_sensor.deinit()
+    return status
 
-    return garage_door_sensor
+# The last state published is kept in sleep memory, so a reload doesn't publish it again unless the door moved
+# (the first heartbeat is a full door_check_wait after start up)
+# Byte 0 marks the memory as ours, byte 1 holds the state
+sleep_memory_marker = 0xA5
+def load_published_state():
+    if alarm.sleep_memory[0] == sleep_memory_marker:
+        return bool(alarm.sleep_memory[1])
+    return None
+
+def save_published_state(status):
+    alarm.sleep_memory[0] = sleep_memory_marker
+    alarm.sleep_memory[1] = int(status)
+
+# minimqtt raises rather than returning False on some versions
+def mqtt_connected():
+    try:
+        return my_mqtt.is_connected()
+    except MMQTTException:
+        return False
 
 
 # Publish messages to MQTT broker(s) or debug log if testing
+# The socket from before the sleep is reused if the broker still has it open
+# Returns True if the message was published
 def do_publish(feed, msg, retain=False):
     if not testing:
         try:
+            if not mqtt_connected():
+                telemetry_counters["reconnects"] += 1
+                my_mqtt.reconnect()
+            sent = time.monotonic()
             my_mqtt.publish(feed, msg, retain)
+            observe(publish_latency, (time.monotonic() - sent) * 1000)
+            telemetry_counters["publishes"] += 1
+            return True
         except MMQTTException as e:
             logger.error(f"unable to connect to local MQTT broker {e}. Nothing published")
-            pass
+            telemetry_counters["publish_failures"] += 1
+            return False
     else:
         logger.debug(f"TESTING: Would publish {msg} to {feed} at remote broker")
+        return True
+
+# --- Telemetry --- #
+# A compact JSON summary is published to telemetry_local_feed/garage with every heartbeat
+# for the hub to serve to Prometheus, so it never costs a wake of its own
+# Counters only ever go up, histograms count observations at or below each bound in le with one
+# more count at the end for anything above the last bound
+telemetry_counters = {"publishes": 0, "publish_failures": 0, "disconnects": 0, "reconnects": 0,
+                      "loop_iterations": 0, "wakes": 0, "door_changes": 0}
+publish_latency = {"le": [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000], "counts": [0] * 11, "sum": 0}
+wake_to_publish = {"le": [50, 100, 200, 300, 500, 1000, 2000, 5000], "counts": [0] * 9, "sum": 0}
+
+def observe(histogram, value):
+    bucket = 0
+    while bucket < len(histogram["le"]) and value > histogram["le"][bucket]:
+        bucket += 1
+    histogram["counts"][bucket] += 1
+    histogram["sum"] += value
+
+def publish_telemetry():
+    if not telemetry_feed:
+        return
+    gc.collect()
+    telemetry = {"device": "garage",
+                 "counters": telemetry_counters,
+                 "gauges": {"uptime_seconds": int(time.monotonic()), "mem_free_bytes": gc.mem_free()},
+                 "histograms": {"publish_latency_ms": publish_latency, "wake_to_publish_ms": wake_to_publish}}
+    do_publish(f"{telemetry_feed}/garage", json.dumps(telemetry))
 
 # Pre-launch start up
-last_known_state = False
-startup = True
-check_time = None
-door_check_wait = 20 # 1800
-garage_door_sensor = None
-status = 2
+# Even if nothing changes the state is published every door_check_wait seconds,
+# so a sensor that has gone quiet can be told apart from a door that hasn't moved
+door_check_wait = 1800
+# A door state that didn't reach the broker is tried again after publish_retry_wait seconds
+publish_retry_wait = 10
+# While the door is closed the door is also read every closed_poll_wait seconds, so an opening is still
+# noticed on a sensor built without the external pull up resistor
+# Set garage_closed_poll_wait to 0 in settings.toml on sensors that have the resistor to only wake on the pin
+closed_poll_wait = int(os.getenv("garage_closed_poll_wait", 60))
+last_known_state = load_published_state()
 my_mqtt.connect()
 logger.info("Garage door sensor online")
+# Telemetry goes out at start up so a reboot shows up straight away, the door state only if it has changed
+publish_telemetry()
 
 # Main
+# On every wake the door is read and any change published straight away, MQTT housekeeping happens afterwards
+# The board sleeps until the pin reaches the opposite level to the door's current state, so it wakes on
+# the door opening and closing, or until the next heartbeat, publish retry or closed door poll is due
+woke_at = time.monotonic()
+next_heartbeat = woke_at + door_check_wait
 while True:
-    if garage_door_sensor is None:
-        garage_door_sensor = set_up_sensor()
-        status = garage_door_sensor.value
+    telemetry_counters["loop_iterations"] += 1
+    heartbeat_due = time.monotonic() >= next_heartbeat
+    if heartbeat_due:
+        next_heartbeat = time.monotonic() + door_check_wait
+    wake_at = next_heartbeat
+    status = read_door_state()
+    if last_known_state is None or status != last_known_state:
+        logger.info("Garage door state has changed, publishing to MQTT")
+        if do_publish(garage_door_feed, int(status), True):
+            save_published_state(status)
+            last_known_state = status
+            latency = (time.monotonic() - woke_at) * 1000
+            observe(wake_to_publish, latency)
+            telemetry_counters["door_changes"] += 1
+            logger.info(f"door state published {latency:.0f} ms after waking")
+        else:
+            wake_at = min(wake_at, time.monotonic() + publish_retry_wait)
+    elif heartbeat_due:
+        logger.info("Heartbeat, publishing the unchanged door state to MQTT")
+        do_publish(garage_door_feed, int(status), True)
+    else:
+        logger.debug("Nothing has changed, not publishing to MQTT")
+    if heartbeat_due:
+        publish_telemetry()
 
     try:
-        my_mqtt.loop(timeout=5)
+        my_mqtt.loop(timeout=1)
     except MMQTTException:
         logger.error("Local MMQT unavailable, will reconnect")
         my_mqtt.disconnect()
         pass
 
-    if startup:
-        logger.info("System has started, publishing to MQTT")
-        do_publish(garage_door_feed, int(status), True)
-        startup = False
-        last_known_state = status
-    elif last_known_state is not status and startup is False:
-        logger.info("Garage door state has changed, publishing to MQTT")
-        do_publish(garage_door_feed, int(status), True)
-        last_known_state = status
-    else:
-        logger.debug("Nothing has changed, not publishing to MQTT")
-
-    if garage_door_sensor is not None:
-        garage_door_sensor.deinit()
-        garage_door_sensor = None
-    sleep_alarm = alarm.pin.PinAlarm(sensor_pin, value=False, edge=False)
-    check_time = time.monotonic()
-    logger.info(f"going into light sleep at {check_time}")
-    alarm.light_sleep_until_alarms(sleep_alarm)
-
-
-
+    # A pin alarm can only pull the pin away from the level it waits for, so it gives us the internal pull up
+    # while waiting for the pin to go low but would pull the pin down while waiting for it to go high
+    # The pin can't stay configured either, deinit() in read_door_state resets it and CircuitPython won't
+    # arm an alarm on a pin in use, so waiting for high relies on the external pull up resistor
+    # Without the resistor the pin may never go high, so while the door is closed wake up to read it anyway
+    if not status and closed_poll_wait:
+        wake_at = min(wake_at, time.monotonic() + closed_poll_wait)
+    door_alarm = alarm.pin.PinAlarm(sensor_pin, value=not status, edge=False, pull=status)
+    timer_alarm = alarm.time.TimeAlarm(monotonic_time=max(wake_at, time.monotonic() + 1))
+    logger.info(f"going into light sleep at {time.monotonic()}")
+    alarm.light_sleep_until_alarms(door_alarm, timer_alarm)
+    woke_at = time.monotonic()
+    telemetry_counters["wakes"] += 1
@@ -1,7 +1,12 @@
 # SPDX-License-Identifier: MIT
 import os
+import gc
+import json
 import time
+import alarm.pin
+import alarm.time
 import board
+import countio
 import digitalio
 import wifi
 import adafruit_minimqtt.adafruit_minimqtt
@@ -51,6 +56,7 @@ def on_disconnect(mqtt_client, userdata, rc):
     # This method is called when the mqtt_client disconnects
     # from the broker.
     logger.info(f"Disconnected from MQTT Broker!")
+    telemetry_counters["disconnects"] += 1
     counter = 0
     while counter <= 10:
         try:
@@ -78,10 +84,10 @@ def on_message(client, topic, message):
     global is_recording
     logger.info(f"New message on topic {topic}: {message}")
     if "recording" in topic:
-        if message is "1":
+        if message == "1":
             if not is_recording:
                 is_recording = True
-        if message is "0":
+        if message == "0":
             if is_recording:
                 do_publish(motion_feed, 0)
                 is_recording = False
@@ -89,6 +95,10 @@ def on_message(client, topic, message):
         logger.info(f"recording state={is_recording}")
 
 # MQTT set up
+# Between PIR triggers the board light sleeps, waking every keep_alive_interval seconds to ping the broker
+# so the session survives the sleep
+keep_alive = 60
+keep_alive_interval = 45
 local_mqtt_broker = os.getenv("mqtt_local_server")
 local_mqtt_port = os.getenv("mqtt_local_port")
 local_mqtt_username = os.getenv("mqtt_local_username_motion")
@@ -97,6 +107,7 @@ local_mqtt_password = os.getenv("mqtt_local_key_motion")
 # Feeds
 motion_feed = os.getenv("motion_detect_local_feed")
 recording_feed = os.getenv("local_recording_on_feed")
+telemetry_feed = os.getenv("telemetry_local_feed")
 
 my_mqtt = adafruit_minimqtt.adafruit_minimqtt.MQTT(
     broker=local_mqtt_broker
@@ -106,6 +117,7 @@ my_mqtt = adafruit_minimqtt.adafruit_minimqtt.MQTT(
     , ssl_context = ssl_context
     , socket_pool=pool
     , is_ssl=False
+    , keep_alive=keep_alive
 )
 
 # Connect callback handlers to mqtt_client
@@ -117,11 +129,27 @@ my_mqtt.on_publish = on_publish
 my_mqtt.on_message = on_message
 
 # --- PIR Sensor --- #
+# Only rising edges of the PIR count as motion, so it is published once however long the PIR stays high
+# While awake the edges are counted in hardware, while asleep a pin alarm wakes the board when the PIR goes high
+# The ESP32-S3 can only wake on a level, so before sleeping we wait for the PIR to go low again,
+# otherwise a PIR that is still high would wake the board straight away
+# After publishing motion we stay awake for recording_wait seconds to hear the camera start recording,
+# and for as long as it is recording, because incoming messages don't wake the board from light sleep
 sensor = board.D2
 logger.info(f"sensor is on pin {sensor}")
-pir = digitalio.DigitalInOut(sensor)
-pir.direction = digitalio.Direction.INPUT
-pir.pull = digitalio.Pull.UP
+recording_wait = 10
+
+def start_edge_counter():
+    return countio.Counter(sensor, edge=countio.Edge.RISE, pull=digitalio.Pull.UP)
+
+# Keep MQTT going until the PIR is low, no rising edge can be missed while it is still high
+def wait_for_pir_low():
+    pir = digitalio.DigitalInOut(sensor)
+    pir.direction = digitalio.Direction.INPUT
+    pir.pull = digitalio.Pull.UP
+    while pir.value:
+        service_mqtt(2)
+    pir.deinit()
 
 # --- Non-MQTT Related Methods --- #
 
@@ -132,9 +160,13 @@ def do_publish(feed, msg):
     else:
         logger.info(f"preparing to publish {msg} to {feed}")
         try:
+            sent = time.monotonic()
             my_mqtt.publish(feed, msg)
+            observe_publish_latency((time.monotonic() - sent) * 1000)
+            telemetry_counters["publishes"] += 1
         except MMQTTException:
             print("unable to connect to remote MQTT broker, message not sent")
+            telemetry_counters["publish_failures"] += 1
             pass
         except BrokenPipeError:
             my_mqtt.disconnect()
@@ -146,12 +178,64 @@ def do_publish(feed, msg):
             pass
 
 # Notify the camera that motion has been detected
+# Returns True if the camera was told
 def motion_detected():
     if not is_recording:
         logger.info(f"motion detected and we are not currently recording")
         do_publish(motion_feed, 1)
+        return True
     else:
         logger.info(f"we are recording, nothing more to do")
+        return False
+
+# Handle MQTT traffic, reconnecting if the broker has gone away
+def service_mqtt(timeout):
+    try:
+        my_mqtt.loop(timeout=timeout)
+    except MMQTTException:
+        logger.error("MMQT unavailable, will reconnect")
+        my_mqtt.disconnect()
+        pass
+
+# Keep the MQTT session alive while we sleep
+def keep_mqtt_alive():
+    try:
+        my_mqtt.ping()
+    except MMQTTException:
+        logger.error("MMQT ping failed, will reconnect")
+        my_mqtt.disconnect()
+        pass
+    service_mqtt(2)
+
+# --- Telemetry --- #
+# Every telemetry_interval seconds a compact JSON summary is published to telemetry_local_feed/motion
+# for the hub to serve to Prometheus, it goes out on a keep alive wake so it never costs a wake of its own
+# Counters only ever go up, the latency histogram counts publishes at or below each bound in le with one
+# more count at the end for anything slower
+telemetry_interval = 300
+telemetry_counters = {"publishes": 0, "publish_failures": 0, "disconnects": 0, "loop_iterations": 0,
+                      "wakes": 0, "motion_edges": 0}
+publish_latency = {"le": [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000], "counts": [0] * 11, "sum": 0}
+next_telemetry = time.monotonic()
+
+def observe_publish_latency(latency):
+    bucket = 0
+    while bucket < len(publish_latency["le"]) and latency > publish_latency["le"][bucket]:
+        bucket += 1
+    publish_latency["counts"][bucket] += 1
+    publish_latency["sum"] += latency
+
+def publish_telemetry():
+    global next_telemetry
+    if not telemetry_feed or time.monotonic() < next_telemetry:
+        return
+    next_telemetry = time.monotonic() + telemetry_interval
+    gc.collect()
+    telemetry = {"device": "motion",
+                 "counters": telemetry_counters,
+                 "gauges": {"uptime_seconds": int(time.monotonic()), "mem_free_bytes": gc.mem_free()},
+                 "histograms": {"publish_latency_ms": publish_latency}}
+    do_publish(f"{telemetry_feed}/motion", json.dumps(telemetry))
 
 
 # --- Pre start setup --- #
@@ -160,13 +244,34 @@ do_publish(motion_feed, 0)
 logger.info("motion detector online")
 
 # --- Startup --- #
+edge_counter = start_edge_counter()
+awake_until = 0
 while True:
-    try:
-        my_mqtt.loop(timeout=5)
-    except MMQTTException:
-        logger.error("MMQT unavailable, will reconnect")
-        my_mqtt.disconnect()
-        pass
+    telemetry_counters["loop_iterations"] += 1
+    if edge_counter.count:
+        telemetry_counters["motion_edges"] += edge_counter.count
+        edge_counter.reset()
+        if motion_detected():
+            awake_until = time.monotonic() + recording_wait
 
-    if pir.value:
-        motion_detected()
\ No newline at end of file
+    if is_recording or time.monotonic() < awake_until:
+        service_mqtt(2)
+        continue
+
+    # Nothing happening, sleep until the PIR goes high or it is time to ping the broker
+    edge_counter.deinit()
+    wait_for_pir_low()
+    motion_alarm = alarm.pin.PinAlarm(sensor, value=True, edge=False)
+    keep_alive_alarm = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + keep_alive_interval)
+    logger.debug(f"going into light sleep at {time.monotonic()}")
+    woke_by = alarm.light_sleep_until_alarms(motion_alarm, keep_alive_alarm)
+    edge_counter = start_edge_counter()
+    telemetry_counters["wakes"] += 1
+
+    if isinstance(woke_by, alarm.pin.PinAlarm):
+        telemetry_counters["motion_edges"] += 1
+        if motion_detected():
+            awake_until = time.monotonic() + recording_wait
+    else:
+        keep_mqtt_alive()
+        publish_telemetry()
\ No newline at end of file
@@ -1,9 +1,19 @@
 # SPDX-License-Identifier: MIT
 import os
 import time
+import asyncio
+import random
+import bisect
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import uuid
 import json
+import re
+import threading
+from collections import deque
+import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
 from google.auth.transport.requests import Request
@@ -36,8 +46,8 @@ logger = logging.getLogger(__name__)
 # load environment variables
 load_dotenv()
 
-# list of feeds to subscribe to
-feeds_list = []
+# Feeds to subscribe to and the handler for each, add to it with add_feed_handler
+feed_handlers = {}
 
 # --- MQTT Configuration --- #
 
@@ -48,7 +58,11 @@ client_pem = os.getenv('MQTT_CLIENT_PEM')
 client_username = os.getenv('MQTT_USERNAME')
 client_password = os.getenv('MQTT_PASSWORD')
 
+# The hub's MQTT client, created at start up
+mqtt_client = None
+
 # --- MQTT methods for handling traffic --- #
+# One client both publishes and subscribes, so there is a single broker session to keep alive
 # Set up MQTT client and connect to broker
 def connect_mqtt(cname):
     logger.info(f"Connecting to {cname} MQTT Broker!")
@@ -59,55 +73,121 @@ def connect_mqtt(cname):
     client.tls_set(ca_certs=ca_cert_file, certfile=client_pem, keyfile=None, keyfile_password=None)
     client.username_pw_set(client_username, client_password)
     client.on_connect = on_connect
+    client.on_connect_fail = on_connect_fail
     client.on_disconnect = on_disconnect
     client.on_message = on_message
-    if "sub" in client.client_id:
-        client.connect_async(host=mqtt_server, port=int(mqtt_port), keepalive=60, clean_start=True)
-    else:
-        client.connect_async(mqtt_server, port=int(mqtt_port), keepalive=60)
+    client.on_publish = on_publish
+    # A mistake in one of our callbacks is logged rather than taking down the network thread
+    client.enable_logger(logger)
+    client.suppress_exceptions = True
+    for feed, handler in feed_handlers.items():
+        client.message_callback_add(feed, handler)
+    client.connect_async(host=mqtt_server, port=int(mqtt_port), keepalive=60, clean_start=True)
 
     return client
 
+# Register the handler for messages on a feed, the feed is subscribed to every time the client connects
+# Handlers take the same arguments as on_message
+def add_feed_handler(feed, handler):
+    feed_handlers[feed] = handler
+    if mqtt_client is not None:
+        mqtt_client.message_callback_add(feed, handler)
+        if mqtt_client.is_connected():
+            mqtt_client.subscribe(feed)
+
 # What to do when the client connects
 def on_connect(client, userdata, flags, reason_code, properties):
+    global disconnected_at
     logger.debug(f"Connected to {client.client_id} MQTT Broker!")
-    if "sub" in client.client_id:
-        # Subscribe to any feeds
-        if feeds_list:
-            for feed in feeds_list:
-                client.subscribe(feed)
-                logger.info(f"subscribed sub_mqtt to {feed}")
-        else:
-            logger.info("there are no feeds in the list")
+    if disconnected_at is not None:
+        recovery = time.monotonic() - disconnected_at
+        reconnect_stats["attempts"] += 1
+        reconnect_stats["reconnects"] += 1
+        reconnect_stats["last_recovery"] = recovery
+        reconnect_stats["max_recovery"] = max(reconnect_stats["max_recovery"] or 0, recovery)
+        logger.info("Reconnected after %.1f seconds", recovery)
+        disconnected_at = None
+    # Subscribe to any feeds
+    if feed_handlers:
+        for feed in feed_handlers:
+            client.subscribe(feed)
+            logger.info(f"subscribed to {feed}")
+    else:
+        logger.info("there are no feeds in the list")
+    replay_offline_publishes()
 
 # Auto reconnect logic
+# paho's network thread (loop_start) does all the socket work and reconnects by itself whenever the connection
+# is lost, backing off exponentially from FIRST_RECONNECT_DELAY up to MAX_RECONNECT_DELAY and never giving up,
+# so once the broker is back we are connected again within MAX_RECONNECT_DELAY seconds
+# Nothing else ever touches the socket, publish() just queues the message for that thread
 FIRST_RECONNECT_DELAY = 1
-RECONNECT_RATE = 2
-MAX_RECONNECT_COUNT = 12
 MAX_RECONNECT_DELAY = 60
-def on_disconnect(client, userdata, rc):
-    logger.error("Disconnected with result code: %s", rc)
-    reconnect_count, reconnect_delay = 0, FIRST_RECONNECT_DELAY
-    while reconnect_count < MAX_RECONNECT_COUNT:
-        logger.info("Reconnecting in %d seconds...", reconnect_delay)
-        time.sleep(reconnect_delay)
-        try:
-            client.reconnect()
-            logger.info("Reconnected successfully!")
-            return
-        except Exception as err:
-            logger.error("%s. Reconnect failed. Retrying...", err)
-        reconnect_delay *= RECONNECT_RATE
-        reconnect_delay = min(reconnect_delay, MAX_RECONNECT_DELAY)
-        reconnect_count += 1
-    logger.error("Reconnect failed after %s attempts. Exiting...", reconnect_count)
+reconnect_stats = {"disconnects": 0, "attempts": 0, "reconnects": 0, "last_recovery": None, "max_recovery": None}
+disconnected_at = None
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+    global disconnected_at
+    logger.error("Disconnected with result code: %s", reason_code)
+    reconnect_stats["disconnects"] += 1
+    if disconnected_at is None:
+        disconnected_at = time.monotonic()
+    # Anything still waiting for the broker is lost with the session, so stop waiting for it
+    with publish_lock:
+        pending_publishes.clear()
+        early_publishes.clear()
+
+# A reconnect attempt failed, paho will try again after its back off
+def on_connect_fail(client, userdata):
+    reconnect_stats["attempts"] += 1
+    logger.debug("Reconnect failed, retrying")
+
+def start_mqtt_network_loop(client):
+    client.reconnect_delay_set(min_delay=FIRST_RECONNECT_DELAY, max_delay=MAX_RECONNECT_DELAY)
+    client.loop_start()
 
 # Subscribe method for MQTT
-# What to do when the subscriber gets a message
+# What to do when we get a message on a feed with no handler of its own
 def on_message(client, userdata, msg):
     received_msg = msg.payload.decode("utf-8")
     logger.debug("message payload is %s for topic %s", received_msg, msg.topic)
 
+# Publish latency, from handing a message to the client until the broker has it
+# (for QoS 0 that is when it has been written to the socket)
+# Each bucket counts publishes that took at most that many milliseconds, the last one catches everything slower
+# The network thread can send a QoS 0 message and call on_publish before publish() has even returned the mid
+# to us, those acks wait in early_publishes until send_publish picks them up
+# publish_lock only guards our own bookkeeping, it is never held while calling into the client
+publish_latency_buckets = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf")]
+publish_latency_counts = [0] * len(publish_latency_buckets)
+publish_latency_sum = 0
+pending_publishes = {}
+early_publishes = {}
+publish_lock = threading.Lock()
+
+# What to do when the broker has a message we published
+def on_publish(client, userdata, mid, reason_code, properties):
+    with publish_lock:
+        sent = pending_publishes.pop(mid, None)
+        if sent is None:
+            early_publishes[mid] = time.monotonic()
+            return
+        record_publish_latency(mid, sent, time.monotonic())
+
+# Call with publish_lock held
+def record_publish_latency(mid, sent, acknowledged):
+    global publish_latency_sum
+    latency = (acknowledged - sent) * 1000
+    publish_latency_sum += latency
+    publish_latency_counts[bisect.bisect_left(publish_latency_buckets, latency)] += 1
+    logger.debug("publish %s acknowledged after %.1f ms", mid, latency)
+
+def get_publish_latency_stats():
+    with publish_lock:
+        return {"buckets": dict(zip(publish_latency_buckets, publish_latency_counts)),
+                "count": sum(publish_latency_counts),
+                "sum": publish_latency_sum,
+                "pending": len(pending_publishes)}
+
 # MQTT feeds for date and time - pub
 date_feed = os.getenv("DATE_FEED")
 time_feed = os.getenv("TIME_FEED")
@@ -142,6 +222,42 @@ def get_time():
         do_publish(hour_feed, now_hour, True)
         stored_hour = now_hour
 
+# --- Shared HTTP session --- #
+# Every outbound API call goes through one pooled session so connections are kept alive between reports
+# Requests are gzip compressed, always time out (connect, read) and are retried with back off on failures
+# Everything has to fit inside the weather task's timeout, otherwise the request carries on in its thread
+# after the task has given up on it: 3 tries of up to 5 + 10 seconds plus 1 second of back off is 46 seconds,
+# and a Retry-After header from the server is not waited for since it could be longer than that
+http_timeout = (5, 10)
+http_retries = Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"],
+                     respect_retry_after_header=False)
+http_session = requests.Session()
+http_session.headers.update({"Accept-Encoding": "gzip, deflate"})
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=http_retries))
+
+# GET a JSON document using the shared session
+# If the server gave us an ETag or Last-Modified last time ask only for changes and reuse the last body on a 304
+http_cache = {}
+def http_get_json(url):
+    headers = {}
+    cached = http_cache.get(url)
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    response = http_session.get(url, headers=headers, timeout=http_timeout)
+    if response.status_code == 304 and cached is not None:
+        logger.debug("%s has not changed, using the last response", url.split("?")[0])
+        return cached["body"]
+    response.raise_for_status()
+    body = response.json()
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        http_cache[url] = {"etag": etag, "last_modified": last_modified, "body": body}
+    return body
+
 # --- Weather, Air Quality, so2 (vog indicator) --- #
 
 # Per Openweathermap API query every 10 minutes for most accurate information
@@ -156,71 +272,70 @@ sunset_feed = os.getenv("SUNSET_FEED")
 sunrise_feed = os.getenv("SUNRISE_FEED")
 
 # Gather all the weather and air quality data and format it into a report
-last_report = None
+# How often this runs is decided by the task scheduler
+# The weather and air quality requests are made at the same time rather than one after the other
 info_spacer = '\u25AA'
-def get_weather():
-    global last_report
+async def get_weather():
     degree_symbol = '\u00b0'
-    if last_report is None or time.monotonic() > last_report + weather_report_wait:
+    try:
+        weather, air_quality_report = await asyncio.gather(
+            asyncio.to_thread(http_get_json, weather_feed),
+            asyncio.to_thread(http_get_json, air_quality_feed),
+        )
+        condition = (weather["weather"][0]["description"])
+        high_temp = (weather["main"]["temp_max"])
+        low_temp = (weather["main"]["temp_min"])
+        temperature = (weather["main"]["temp"])
+        feels_like = (weather["main"]["feels_like"])
+        wind_speed = (weather["wind"]["speed"])
+        wind_direction = (weather["wind"]["deg"])
+        direction = get_wind_direction(wind_direction)
+        humidity = (weather["main"]["humidity"])
+        sunrise_unix = (weather["sys"]["sunrise"])
+        sunset_unix = (weather["sys"]["sunset"])
+        sunrise = timeHelper.format_time(sunrise_unix)
+        sunset  = timeHelper.format_time(sunset_unix)
+        air_quality, so2, so2_quality = get_air_quality(air_quality_report)
+        pressure = (weather["main"]["pressure"])
+        pressure_indicator, publish_pressure, rain_indicator = get_pressure_info(pressure)
         try:
-            weather_request = requests.get(weather_feed)
-            weather = weather_request.json()
-            condition = (weather["weather"][0]["description"])
-            high_temp = (weather["main"]["temp_max"])
-            low_temp = (weather["main"]["temp_min"])
-            temperature = (weather["main"]["temp"])
-            feels_like = (weather["main"]["feels_like"])
-            wind_speed = (weather["wind"]["speed"])
-            wind_direction = (weather["wind"]["deg"])
-            direction = get_wind_direction(wind_direction)
-            humidity = (weather["main"]["humidity"])
-            sunrise_unix = (weather["sys"]["sunrise"])
-            sunset_unix = (weather["sys"]["sunset"])
-            sunrise = timeHelper.format_time(sunrise_unix)
-            sunset  = timeHelper.format_time(sunset_unix)
-            air_quality, so2, so2_quality = get_air_quality()
-            pressure = (weather["main"]["pressure"])
-            pressure_indicator, publish_pressure, rain_indicator = get_pressure_info(pressure)
-            try:
-                wind_gust = (weather["wind"]["gust"])
-                weather_for_dash = {"condition": f"{str(condition)}",
-                        "high_low": f"{str(int(high_temp))}{degree_symbol}C / {str(int(low_temp))}{degree_symbol}C",
-                        "temperature": f"{str(int(temperature))}{degree_symbol}C feels like {int(feels_like)}{degree_symbol}",
-                        "wind": f"{str(wind_speed)} m/sec {direction}",
-                        "wind gust": f"{str(wind_gust)} m/sec",
-                        "humidity": f"{str(int(humidity))}%",
-                        "sunrise": f"{str(sunrise)}",
-                        "sunset": f"{str(sunset)}",
-                        "air quality": f"{str(air_quality)}",
-                        "vog": f"{float(so2)} {str(so2_quality)}",
-                        "pressure": f"{float(publish_pressure)} mmHg {pressure_indicator} {rain_indicator}",}
-            except KeyError:
-                weather_for_dash = {"condition": f"{str(condition)}",
-                        "high_low": f"{str(int(high_temp))}{degree_symbol}C / {str(int(low_temp))}{degree_symbol}C",
-                        "temperature": f"{str(int(temperature))}{degree_symbol}C feels like {int(feels_like)}{degree_symbol}",
-                        "wind": f"{str(wind_speed)} m/sec {direction}",
-                        "humidity": f"{str(int(humidity))}%",
-                        "sunrise": f"{str(sunrise)}",
-                        "sunset": f"{str(sunset)}",
-                        "air quality": f"{str(air_quality)}",
-                        "vog": f"{float(so2)} {str(so2_quality)}",
-                        "pressure": f"{float(publish_pressure)} mmHg {pressure_indicator} {rain_indicator}",}
-                pass
-
-            sunset_hr, sunset_minute, sunset_second = sunset.split(":")
-            sunset_info = f"{sunset_hr}:{sunset_minute}"
-            sunrise_hr, sunrise_minute, sunrise_second = sunrise.split(":")
-            sunrise_info = f"{sunrise_hr}:{sunrise_minute}"
-
-            logger.debug("updating weather report on dashboard")
-            do_publish(pub_weather_feed, json.dumps(weather_for_dash), True)
-            do_publish(sunset_feed, sunset_info, True)
-            do_publish(sunrise_feed, sunrise_info, True)
-        except ConnectionError:
-            logger.error("Connection error trying to get the weather")
+            wind_gust = (weather["wind"]["gust"])
+            weather_for_dash = {"condition": f"{str(condition)}",
+                    "high_low": f"{str(int(high_temp))}{degree_symbol}C / {str(int(low_temp))}{degree_symbol}C",
+                    "temperature": f"{str(int(temperature))}{degree_symbol}C feels like {int(feels_like)}{degree_symbol}",
+                    "wind": f"{str(wind_speed)} m/sec {direction}",
+                    "wind gust": f"{str(wind_gust)} m/sec",
+                    "humidity": f"{str(int(humidity))}%",
+                    "sunrise": f"{str(sunrise)}",
+                    "sunset": f"{str(sunset)}",
+                    "air quality": f"{str(air_quality)}",
+                    "vog": f"{float(so2)} {str(so2_quality)}",
+                    "pressure": f"{float(publish_pressure)} mmHg {pressure_indicator} {rain_indicator}",}
+        except KeyError:
+            weather_for_dash = {"condition": f"{str(condition)}",
+                    "high_low": f"{str(int(high_temp))}{degree_symbol}C / {str(int(low_temp))}{degree_symbol}C",
+                    "temperature": f"{str(int(temperature))}{degree_symbol}C feels like {int(feels_like)}{degree_symbol}",
+                    "wind": f"{str(wind_speed)} m/sec {direction}",
+                    "humidity": f"{str(int(humidity))}%",
+                    "sunrise": f"{str(sunrise)}",
+                    "sunset": f"{str(sunset)}",
+                    "air quality": f"{str(air_quality)}",
+                    "vog": f"{float(so2)} {str(so2_quality)}",
+                    "pressure": f"{float(publish_pressure)} mmHg {pressure_indicator} {rain_indicator}",}
             pass
 
-        last_report = time.monotonic()
+        sunset_hr, sunset_minute, sunset_second = sunset.split(":")
+        sunset_info = f"{sunset_hr}:{sunset_minute}"
+        sunrise_hr, sunrise_minute, sunrise_second = sunrise.split(":")
+        sunrise_info = f"{sunrise_hr}:{sunrise_minute}"
+
+        logger.debug("updating weather report on dashboard")
+        do_publish(pub_weather_feed, json.dumps(weather_for_dash), True)
+        do_publish(sunset_feed, sunset_info, True)
+        do_publish(sunrise_feed, sunrise_info, True)
+    except (ConnectionError, requests.RequestException) as err:
+        logger.error(f"Connection error trying to get the weather: {err}")
+        pass
 
 
 # --- Calendar Events --- #
@@ -228,111 +343,360 @@ def get_weather():
 # MQTT feed for calendar - pub
 calendar_feed = os.getenv("CALENDAR_FEED")
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
-calendar_report_wait = 7200 # Calendar shouldn't change that much, so only check every two hours
-
-# Query a shared Google calendar
-# Grab the next two events to publish
-# Note: if you change the number of events to grab, update the for loop that builds the publish string (until I figure out how to not need to do  this)
-last_calendar_check = None
-events_to_publish = None
-def get_shared_calendar_events():
-    global last_calendar_check, events_to_publish
-    events = []
-    if last_calendar_check is None or time.monotonic() > last_calendar_check + calendar_report_wait:
-        logger.debug("It's time to check the calendar")
-        creds = None
-        wait_time = 120
-        wait_multiplier = 1.2
-        if os.path.exists("token.json"):
-            creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+calendar_report_wait = 300 # Only changes since the last check are fetched, so checking every five minutes is cheap
+calendar_id = "snipcrthka3m1mbm501fa486l4@group.calendar.google.com"
+# How many upcoming events to show on the dashboard
+calendar_event_count = int(os.getenv("CALENDAR_EVENT_COUNT", 2))
+
+# Keep a shared Google calendar in sync and publish the next calendar_event_count events
+# How often this runs is decided by the task scheduler
+# Anything that talks to Google runs in a worker thread and the retry back off is an asyncio sleep,
+# so a slow or failing calendar never holds up the clock
+# The worker thread only fetches changes, they are applied to the local calendar back on the event loop
+# A fetch that timed out keeps running in its thread, no new one is started until it has finished
+# The dashboard is only updated when the events it shows have actually changed
+calendar_request_timeout = 60
+last_calendar_message = None
+calendar_fetch = None
+async def get_shared_calendar_events():
+    global calendar_fetch
+    logger.debug("It's time to check the calendar")
+    wait_time = 120
+    wait_multiplier = 1.2
+    await asyncio.to_thread(get_calendar_credentials)
+    for attempt in range(5):
+        if calendar_fetch is not None and not calendar_fetch.done():
+            logger.info("the last calendar fetch is still running, skipping this one")
+            break
+        try:
+            calendar_fetch = asyncio.ensure_future(asyncio.to_thread(fetch_calendar_changes, get_calendar_sync_token()))
+            fetched = await asyncio.wait_for(asyncio.shield(calendar_fetch), calendar_request_timeout)
+            changes = apply_calendar_changes(*fetched)
+            logger.debug(f"calendar sync found {changes} changed events")
+            break
+        except (HttpError, asyncio.TimeoutError) as error:
+            logger.error(f"An error occurred: {error}, retrying")
+            if isinstance(error, asyncio.TimeoutError):
+                # The connection may be wedged, start the next attempt with a fresh one
+                reset_calendar_service()
+            if attempt == 0:
+                await asyncio.sleep(wait_time)
+            elif attempt <= 4:
+                await asyncio.sleep(wait_time*wait_multiplier)
+                wait_time = wait_time*wait_multiplier
             else:
-                flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-                creds = flow.run_local_server(port=0)
-            with open("token.json", "w") as token:
-                token.write(creds.to_json())
-        for attempt in range(5):
-            try:
-                service = build("calendar", "v3", credentials=creds)
-                now = timeHelper.get_unix_time()
-                events_result = (
-                    service.events().list(
-                        calendarId="snipcrthka3m1mbm501fa486l4@group.calendar.google.com",
-                        timeMin=now,
-                        maxResults=2,
-                        singleEvents=True,
-                        orderBy="startTime",
-                    )
-                    .execute()
-                )
-                events = events_result.get("items", [])
-                break
-            except HttpError as error:
-                logger.error(f"An error occurred: {error}, retrying")
-                if attempt == 0:
-                    time.sleep(wait_time)
-                elif attempt <= 4:
-                    time.sleep(wait_time*wait_multiplier)
-                    wait_time = wait_time*wait_multiplier
-                else:
-                    logger.error("unable to retrieve events, abandoning")
-            attempt += 1
+                logger.error("unable to retrieve events, abandoning")
+        attempt += 1
 
-        pub_array = []
-        if not events:
-            pub_events = "No upcoming events found."
-            pub_array.append({"timestamp": "", "event": pub_events})
-        else:
-            for event in events:
-                publish_event = event["summary"]
-                event_datetime = event["start"].get("dateTime")
-                if event_datetime is not None:
-                    event_date, event_time = event_datetime.split("T")
-                    event_year, event_month, event_day = event_date.split("-")
-                    full_month = calendarHelper.get_month_name(event_month)
-                    event_start_time, event_end_time = event_time.split("-")
-                    event_time_hr, event_time_min, event_time_sec = event_start_time.split(":")
-                    publish_datetime = f"{event_day} {full_month} {event_year} at {event_time_hr}:{event_time_min}"
-                    pub_array.append({"timestamp": publish_datetime, "event": publish_event})
-                else:
-                    event_date = event["start"].get("date")
-                    event_year, event_month, event_day = event_date.split("-")
-                    full_month = calendarHelper.get_month_name(event_month)
-                    publish_date = f"{event_day} {full_month} {event_year}"
-                    pub_array.append({"timestamp": publish_date, "event": + publish_event})
+    publish_calendar_events()
+
+# Drop events that have started from the local calendar, and update the dashboard if that changed what it shows
+# Runs every minute and never talks to Google
+def expire_calendar_events():
+    if expire_started_events():
+        publish_calendar_events()
 
-        if len(pub_array) == 1:
-            pub_array.append({"timestamp": "", "event": ""})
+# Publish the next calendar_event_count events, padded with blanks so the dashboard always gets the same number
+def publish_calendar_events():
+    global last_calendar_message
+    events = calendar_index[:calendar_event_count]
+    pub_array = []
+    if not events:
+        pub_events = "No upcoming events found."
+        pub_array.append({"timestamp": "", "event": pub_events})
+    else:
+        for key, event_id in events:
+            event = calendar_events[event_id]
+            publish_event = event.get("summary", "")
+            event_datetime = event["start"].get("dateTime")
+            if event_datetime is not None:
+                event_year, event_month, event_day = event_datetime[:10].split("-")
+                full_month = calendarHelper.get_month_name(event_month)
+                event_time_hr, event_time_min = event_datetime[11:16].split(":")
+                publish_datetime = f"{event_day} {full_month} {event_year} at {event_time_hr}:{event_time_min}"
+                pub_array.append({"timestamp": publish_datetime, "event": publish_event})
+            else:
+                event_date = event["start"].get("date")
+                event_year, event_month, event_day = event_date.split("-")
+                full_month = calendarHelper.get_month_name(event_month)
+                publish_date = f"{event_day} {full_month} {event_year}"
+                pub_array.append({"timestamp": publish_date, "event": publish_event})
+
+    while len(pub_array) < calendar_event_count:
+        pub_array.append({"timestamp": "", "event": ""})
 
-        message = json.dumps(pub_array)
+    message = json.dumps(pub_array)
 
+    if message != last_calendar_message:
         logger.debug("Publishing calendar events")
         do_publish(calendar_feed, message, True)
-
-        last_calendar_check = time.monotonic()
+        last_calendar_message = message
+    else:
+        logger.debug("Upcoming calendar events have not changed, not publishing")
 
 # --- Supporting task handling methods --- #
 
+# The Google credentials and calendar service are kept for the life of the hub
+# token.json is only read at start up and only written when the token actually changes
+# Credentials are refreshed ahead of expiry so a poll never has to stop and refresh mid request
+# The service is built once and its HTTP connection is reused for every poll
+calendar_creds = None
+calendar_service = None
+calendar_token_json = None
+calendar_refresh_margin = 300
+
+# Load the Google credentials, refreshing or re-authorising if they are close to expiring or no longer valid
+def get_calendar_credentials():
+    global calendar_creds, calendar_service
+    if calendar_creds is None and os.path.exists("token.json"):
+        calendar_creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    creds = calendar_creds
+    if creds and creds.refresh_token:
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if not creds.valid or (creds.expiry and creds.expiry - now < datetime.timedelta(seconds=calendar_refresh_margin)):
+            logger.debug("refreshing calendar credentials")
+            creds.refresh(Request(session=http_session))
+    elif not creds or not creds.valid:
+        flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+        creds = flow.run_local_server(port=0)
+        calendar_creds = creds
+        calendar_service = None
+    save_calendar_token()
+    return creds
+
+# Write token.json, but only if the token has changed since we last read or wrote it
+def save_calendar_token():
+    global calendar_token_json
+    if calendar_creds is None:
+        return
+    token_json = calendar_creds.to_json()
+    if calendar_token_json is None and os.path.exists("token.json"):
+        with open("token.json", "r") as token:
+            calendar_token_json = token.read()
+    if token_json != calendar_token_json:
+        logger.info("calendar token has changed, saving token.json")
+        with open("token.json", "w") as token:
+            token.write(token_json)
+        calendar_token_json = token_json
+
+# Build the calendar service the first time it is needed and reuse it after that
+def get_calendar_service():
+    global calendar_service
+    if calendar_service is None:
+        logger.info("building calendar service")
+        calendar_service = build("calendar", "v3", credentials=calendar_creds)
+    return calendar_service
+
+def reset_calendar_service():
+    global calendar_service
+    calendar_service = None
+
+# Incremental calendar sync
+# A full sync lists the next calendar_sync_days of events and Google hands back a sync token,
+# after that only events added, changed or cancelled since the last sync are returned
+# The full sync is repeated every calendar_full_sync_interval seconds to move the window along
+# calendar_events holds every upcoming event by id and calendar_index keeps (start time, id) in start order
+# Changes are slotted into the index one at a time rather than re-sorting the whole calendar
+# Both are only ever touched on the event loop
+calendar_sync_days = 60
+calendar_full_sync_interval = 86400
+calendar_page_size = 250
+calendar_sync_token = None
+calendar_synced_at = None
+calendar_sync_end = None
+calendar_events = {}
+calendar_index = []
+
+# The sync token to use next, None when it is time for a full sync
+def get_calendar_sync_token():
+    if calendar_synced_at is None or time.monotonic() - calendar_synced_at > calendar_full_sync_interval:
+        return None
+    return calendar_sync_token
+
+# Fetch the changes since sync_token, or everything in the sync window if it is None
+# Runs in a worker thread, so it returns what it found and leaves the local calendar alone
+# Returns the changed events, the next sync token and the end of the window for a full sync (None otherwise)
+def fetch_calendar_changes(sync_token):
+    service = get_calendar_service()
+    sync_end = None
+    if sync_token is None:
+        sync_end = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=calendar_sync_days)
+        params = {"timeMin": timeHelper.get_unix_time(), "timeMax": sync_end.isoformat()}
+    else:
+        params = {"syncToken": sync_token}
+    changes = []
+    page_token = None
+    while True:
+        try:
+            events_result = service.events().list(
+                calendarId=calendar_id,
+                singleEvents=True,
+                maxResults=calendar_page_size,
+                pageToken=page_token,
+                **params,
+            ).execute()
+        except HttpError as error:
+            # Google expires sync tokens now and then, when that happens start over with a full sync
+            if error.resp.status == 410 and sync_token is not None:
+                logger.info("calendar sync token has expired, doing a full sync")
+                return fetch_calendar_changes(None)
+            raise
+        changes.extend(events_result.get("items", []))
+        page_token = events_result.get("nextPageToken")
+        if page_token is None:
+            break
+    # The service refreshes the token by itself if Google rejects it, keep token.json in step
+    save_calendar_token()
+    return changes, events_result.get("nextSyncToken"), sync_end
+
+# Apply fetched changes to the local calendar, on the event loop
+# Events past the end of the sync window are left for the next full sync
+# Returns how many events changed
+def apply_calendar_changes(changes, sync_token, sync_end):
+    global calendar_sync_token, calendar_synced_at, calendar_sync_end
+    if sync_end is not None:
+        calendar_events.clear()
+        calendar_index.clear()
+        calendar_sync_end = sync_end
+        calendar_synced_at = time.monotonic()
+    for event in changes:
+        remove_calendar_event(event["id"])
+        if event.get("status") != "cancelled" and get_event_time(event["start"]) < calendar_sync_end:
+            add_calendar_event(event)
+    expire_started_events()
+    calendar_sync_token = sync_token
+    return len(changes)
+
+# Turn an event start or end into a datetime, all day events only have a date so use local midnight
+def get_event_time(when):
+    if "dateTime" in when:
+        return datetime.datetime.fromisoformat(when["dateTime"])
+    return datetime.datetime.fromisoformat(when["date"]).astimezone()
+
+def add_calendar_event(event):
+    calendar_events[event["id"]] = event
+    bisect.insort(calendar_index, (get_event_time(event["start"]), event["id"]))
+
+def remove_calendar_event(event_id):
+    event = calendar_events.pop(event_id, None)
+    if event is not None:
+        position = bisect.bisect_left(calendar_index, (get_event_time(event["start"]), event_id))
+        del calendar_index[position]
+
+# Timed events are dropped once they start, all day events (which can run over several days) once they end
+# Everything that has started is at the front of the index, so stop looking at the first event still to come
+# Returns True if anything was dropped
+def expire_started_events():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expired = []
+    for start, event_id in calendar_index:
+        if start > now:
+            break
+        event = calendar_events[event_id]
+        if "dateTime" in event["start"] or get_event_time(event["end"]) <= now:
+            expired.append(event_id)
+    for event_id in expired:
+        remove_calendar_event(event_id)
+    return len(expired) > 0
+
 # Publish to MQTT
-def do_publish(feed, data, retain=False):
+# Publishes are collected and sent together once the current event loop pass is done,
+# if the same feed is published more than once before then only the latest payload is sent
+# Retained feeds remember what they last sent and identical payloads are not sent again
+publish_queue = {}
+last_retained = {}
+publish_counts = {"sent": 0, "coalesced": 0, "unchanged": 0}
+flush_scheduled = False
+def do_publish(feed, data, retain=False, qos=0):
+    global flush_scheduled
+    if feed in publish_queue:
+        publish_counts["coalesced"] += 1
+    publish_queue[feed] = (data, retain, qos)
+    if not flush_scheduled:
+        try:
+            asyncio.get_running_loop().call_soon(flush_publishes)
+            flush_scheduled = True
+        except RuntimeError:
+            # Not on the event loop, nothing else will be batched with this so send it now
+            flush_publishes()
+
+# Send everything waiting in the publish queue
+def flush_publishes():
+    global flush_scheduled
+    flush_scheduled = False
+    batch = list(publish_queue.items())
+    publish_queue.clear()
+    for feed, (data, retain, qos) in batch:
+        if retain and last_retained.get(feed) == str(data):
+            logger.debug("%s has not changed, not publishing", feed)
+            publish_counts["unchanged"] += 1
+            continue
+        if send_publish(feed, data, retain, qos) and retain:
+            last_retained[feed] = str(data)
+    logger.debug("publish counts: %s", publish_counts)
+
+# Hand a message to the client, its network loop is always running so this returns straight away
+# on_publish records how long it took once the broker has it
+# While we are offline messages are held and sent as soon as we reconnect, for retained feeds only
+# the latest payload is kept and other feeds keep the most recent offline_queue_size messages
+# Returns True if the client accepted the message
+offline_queue_size = 100
+offline_retained = {}
+offline_messages = deque(maxlen=offline_queue_size)
+def send_publish(feed, data, retain=False, qos=0):
     if not testing:
-        pub_mqtt_client.loop_start()
+        if not mqtt_client.is_connected():
+            hold_offline_publish(feed, data, retain, qos)
+            return False
         logger.info("I am publishing %s to %s", data, feed)
-        pub_mqtt_client.publish(feed, data, retain=retain)
-        pub_mqtt_client.loop_stop()
+        sent = time.monotonic()
+        result = mqtt_client.publish(feed, data, qos=qos, retain=retain)
+        with publish_lock:
+            acknowledged = early_publishes.pop(result.mid, None)
+            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                if acknowledged is not None:
+                    record_publish_latency(result.mid, sent, acknowledged)
+                else:
+                    pending_publishes[result.mid] = sent
+        if result.rc == mqtt.MQTT_ERR_NO_CONN:
+            hold_offline_publish(feed, data, retain, qos)
+            return False
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.error("unable to publish to %s: %s", feed, mqtt.error_string(result.rc))
+            return False
+        publish_counts["sent"] += 1
+        return True
     else:
         logger.debug("TESTING:")
-        if "sunset" in feed or "time" in feed:
-            logger.debug("Would publish: Topic: %s. Payload: %s. Retain: %s", str(feed), str(data), "true")
+        logger.debug("Would publish: Topic: %s. Payload: %s. Retain: %s", str(feed), str(data), str(retain).lower())
+        return True
+
+def hold_offline_publish(feed, data, retain, qos):
+    logger.info("offline, holding %s for %s until we reconnect", data, feed)
+    with publish_lock:
+        if retain:
+            offline_retained[feed] = (data, qos)
         else:
-            logger.debug("Would publish: Topic: %s. Payload: %s. Retain: %s", str(feed), str(data), "false")
+            offline_messages.append((feed, data, qos))
 
-# Get the air quality and so2 levels
-def get_air_quality():
-    response = requests.get(air_quality_feed)
-    air_quality =  response.json()
+# Send everything held while we were offline, called from on_connect
+def replay_offline_publishes():
+    with publish_lock:
+        retained = list(offline_retained.items())
+        messages = list(offline_messages)
+        offline_retained.clear()
+        offline_messages.clear()
+    if retained or messages:
+        logger.info("replaying %d messages held while offline", len(retained) + len(messages))
+    for feed, (data, qos) in retained:
+        if send_publish(feed, data, True, qos):
+            last_retained[feed] = str(data)
+    for feed, data, qos in messages:
+        send_publish(feed, data, False, qos)
+
+# Get the air quality and so2 levels from the air pollution report
+def get_air_quality(air_quality):
     aq = (air_quality["list"][0]["main"]["aqi"])
     so2 = (air_quality["list"][0]["components"]["so2"])
 
@@ -415,49 +779,257 @@ def get_pressure_info(pressure):
     stored_pressure_indicator = indicator
     return indicator, publish_pressure, rain
 
-# --- The magic begins here --- #
-
-# Log a message indicating if we're in test mode
-if testing:
-    logger.debug("We are TESTING")
-else:
-    logger.info("We are LIVE")
+# --- Task scheduler --- #
+# Every dashboard source runs as its own asyncio task on its own interval and sleeps until it is next due,
+# so the clock keeps ticking on time while the weather or calendar are waiting on the network
+# align pins a task to wall clock multiples of its interval (top of the minute for the clock)
+# jitter adds up to that many random seconds to each run so the API calls don't always land together
+# timeout is how long a coroutine task gets before it is abandoned until its next run
+# needs_wan tasks are skipped while the WAN is down
+# Plain functions are run directly on the event loop, so they must not block
+tasks = {}
+def add_task(name, task, interval, jitter=0, align=False, needs_wan=True, timeout=None):
+    tasks[name] = {"task": task, "interval": interval, "jitter": jitter, "align": align, "needs_wan": needs_wan,
+                   "timeout": timeout, "runs": 0, "last_run": None, "next_run": time.monotonic(), "duration": None}
 
-# Connect to MQTT for publish and subscribe
-logger.info("Connecting publish MQTT client")
-pub_mqtt_client = connect_mqtt("pub")
-logger.info("Connecting subscribe MQTT client")
-sub_mqtt_client = connect_mqtt("sub")
+# Work out when a task should run next based on when its last run started
+def get_next_run(name, started):
+    task = tasks[name]
+    if task["align"]:
+        due = time.monotonic() + task["interval"] - (time.time() % task["interval"])
+    else:
+        due = started + task["interval"]
+    if task["jitter"]:
+        due += random.uniform(0, task["jitter"])
+    return due
 
-# Subscribe to any feeds
-if feeds_list:
-    logger.debug("I have feeds to subscribe to")
+# Run a task forever, sleeping until each run is due
+async def run_task(name):
+    task = tasks[name]
+    while True:
+        await asyncio.sleep(max(0, task["next_run"] - time.monotonic()))
+        started = time.monotonic()
+        if task["needs_wan"] and not wan_state:
+            logger.debug(f"WAN is down, skipping {name}")
+        else:
+            try:
+                if asyncio.iscoroutinefunction(task["task"]):
+                    await asyncio.wait_for(task["task"](), task["timeout"])
+                else:
+                    task["task"]()
+            except asyncio.TimeoutError:
+                logger.error(f"task {name} timed out after {task['timeout']} seconds")
+            except Exception as err:
+                logger.error(f"task {name} failed: {err}")
+            task["runs"] += 1
+            task["last_run"] = time.time()
+            task["duration"] = time.monotonic() - started
+        task["next_run"] = get_next_run(name, started)
 
-# sub_mqtt_client.loop_start()
+# Per task stats, next_run is converted to wall clock time so it can be compared to last_run
+def get_task_stats():
+    stats = {}
+    for name, task in tasks.items():
+        stats[name] = {"runs": task["runs"],
+                       "last_run": task["last_run"],
+                       "next_run": time.time() + task["next_run"] - time.monotonic(),
+                       "duration": task["duration"]}
+    return stats
 
-logger.info("hello world, home hub is starting up!")
-wanCheck_counter = 0
+# Check the WAN is up, the MQTT network thread takes care of reconnecting
+wan_check_wait = 50
 wan_state = True
-while True:
+async def check_connections():
+    global wan_state
+    wan_state = await asyncio.to_thread(wanChecker.py_wan_active)
+    logger.info(f"wan state is {wan_state}")
+    if wan_state and not mqtt_client.is_connected():
+        logger.info("WAN is up but MQTT is still reconnecting")
+    logger.debug(f"task stats: {get_task_stats()}")
+    logger.debug(f"reconnect stats: {reconnect_stats}")
+    logger.debug(f"publish latency: {get_publish_latency_stats()}")
+
+# --- Metrics --- #
+# The camera and sensors publish telemetry JSON to TELEMETRY_FEED/<device>, the latest from each is kept here
+# and served along with the hub's own task, publish and reconnect stats in Prometheus text format
+# on http://<hub>:METRICS_PORT/metrics
+# Telemetry has counters, gauges and histograms, a histogram counts observations at or below each bound
+# in le with one more count at the end for anything above the last bound
+# Names and values come from whatever publishes to the feed, so a metric whose name Prometheus wouldn't accept
+# or whose value isn't a number is left out, and device names are escaped before they go in a label
+telemetry_feed = os.getenv("TELEMETRY_FEED")
+metrics_port = int(os.getenv("METRICS_PORT", 9100))
+device_telemetry = {}
+telemetry_lock = threading.Lock()
+started_at = time.monotonic()
+metric_name_pattern = re.compile(r"[a-zA-Z_:][a-zA-Z0-9_:]*")
+
+def on_telemetry_message(client, userdata, msg):
+    try:
+        telemetry = json.loads(msg.payload)
+    except ValueError as err:
+        logger.error(f"unreadable telemetry on {msg.topic}: {err}")
+        return
+    if not isinstance(telemetry, dict) or \
+            not all(isinstance(telemetry.get(kind, {}), dict) for kind in ("counters", "gauges", "histograms")):
+        logger.error(f"telemetry on {msg.topic} is not in the expected shape")
+        return
+    device = telemetry.get("device", msg.topic.rsplit("/", 1)[-1])
+    with telemetry_lock:
+        reports = device_telemetry.get(device, {}).get("reports", 0)
+        device_telemetry[device] = {"received": time.time(), "reports": reports + 1, "telemetry": telemetry}
+    logger.debug(f"telemetry from {device}: {telemetry}")
+
+# Memory available to the whole Pi and held by this process, in bytes, from /proc
+# Empty where /proc isn't there to read
+def get_memory_gauges():
+    gauges = {}
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    gauges["mem_available_bytes"] = int(line.split()[1]) * 1024
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    gauges["process_resident_bytes"] = int(line.split()[1]) * 1024
+    except (OSError, ValueError) as err:
+        logger.debug(f"could not read memory use: {err}")
+    return gauges
+
+# The hub's own stats in the same shape as the devices' telemetry
+def get_hub_telemetry():
+    latency = get_publish_latency_stats()
+    counters = {f"publish_{name}": count for name, count in publish_counts.items()}
+    counters.update({f"mqtt_{name}": reconnect_stats[name] for name in ("disconnects", "attempts", "reconnects")})
+    gauges = {"uptime_seconds": round(time.monotonic() - started_at),
+              "publish_pending": latency["pending"],
+              "wan_up": int(wan_state)}
+    gauges.update(get_memory_gauges())
+    return {"counters": counters,
+            "gauges": gauges,
+            "histograms": {"publish_latency_ms": {"le": publish_latency_buckets[:-1],
+                                                  "counts": list(latency["buckets"].values()),
+                                                  "sum": latency["sum"]}}}
+
+# Everything we know in Prometheus text format, samples are grouped by metric name as Prometheus expects
+def format_metrics():
+    now = time.time()
+    with telemetry_lock:
+        reports = {device: dict(report) for device, report in device_telemetry.items()}
+    reports["hub"] = {"received": now, "reports": 0, "telemetry": get_hub_telemetry()}
+    metrics = {}
+
+    def add_sample(family, kind, name, labels, value):
+        if not metric_name_pattern.fullmatch(name):
+            logger.debug(f"leaving out metric with an invalid name: {name!r}")
+            return
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            logger.debug(f"leaving out {name}, its value is not a number: {value!r}")
+            return
+        metrics.setdefault(family, (kind, []))[1].append(f"{name}{{{labels}}} {value}")
+
+    for device, report in sorted(reports.items(), key=lambda item: str(item[0])):
+        labels = f'device="{escape_label_value(device)}"'
+        telemetry = report["telemetry"]
+        add_sample("home_telemetry_age_seconds", "gauge", "home_telemetry_age_seconds", labels,
+                   round(now - report["received"], 1))
+        add_sample("home_telemetry_reports_total", "counter", "home_telemetry_reports_total", labels, report["reports"])
+        for name, value in telemetry.get("counters", {}).items():
+            add_sample(f"home_{name}_total", "counter", f"home_{name}_total", labels, value)
+        for name, value in telemetry.get("gauges", {}).items():
+            add_sample(f"home_{name}", "gauge", f"home_{name}", labels, value)
+        for name, histogram in telemetry.get("histograms", {}).items():
+            family = f"home_{name}"
+            try:
+                if len(histogram["counts"]) != len(histogram["le"]) + 1 or \
+                        not all(isinstance(count, int) for count in histogram["counts"]):
+                    raise ValueError("counts don't match the bounds")
+            except (KeyError, TypeError, ValueError) as err:
+                logger.debug(f"leaving out unreadable histogram {family} from {device}: {err}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(histogram["le"]) + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                add_sample(family, "histogram", f"{family}_bucket", f'{labels},le="{bound}"', cumulative)
+            add_sample(family, "histogram", f"{family}_sum", labels, histogram["sum"])
+            add_sample(family, "histogram", f"{family}_count", labels, cumulative)
+
+    for name, task in get_task_stats().items():
+        labels = f'task="{escape_label_value(name)}"'
+        add_sample("home_task_runs_total", "counter", "home_task_runs_total", labels, task["runs"])
+        if task["duration"] is not None:
+            add_sample("home_task_duration_seconds", "gauge", "home_task_duration_seconds", labels, task["duration"])
+        if task["last_run"] is not None:
+            add_sample("home_task_last_run_timestamp_seconds", "gauge", "home_task_last_run_timestamp_seconds",
+                       labels, task["last_run"])
+
+    lines = []
+    for family, (kind, samples) in metrics.items():
+        lines.append(f"# TYPE {family} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+# Label values are quoted, so backslashes, quotes and newlines have to be escaped
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = format_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request: " + format, *args)
+
+def start_metrics_server():
+    server = ThreadingHTTPServer(("", metrics_port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"serving metrics on port {metrics_port}")
+
+# Run every task until the hub is stopped
+async def main():
+    await asyncio.gather(*(run_task(name) for name in tasks))
+
+# --- The magic begins here --- #
+# Only when run as the hub, so the benchmarks can import the functions above
+if __name__ == "__main__":
+    # Log a message indicating if we're in test mode
+    if testing:
+        logger.debug("We are TESTING")
+    else:
+        logger.info("We are LIVE")
 
-    if wanCheck_counter % 100 == 0:
-        wan_state = wanChecker.py_wan_active()
-        wanCheck_counter = 0
-        logger.info(f"wan state is {wan_state}")
+    # Collect telemetry from the other devices
+    if telemetry_feed:
+        add_feed_handler(f"{telemetry_feed}/+", on_telemetry_message)
 
-    mqtt_connected = pub_mqtt_client.is_connected()
+    # Connect to MQTT for publish and subscribe
+    logger.info("Connecting MQTT client")
+    mqtt_client = connect_mqtt("hub")
 
-    if wan_state:
-        if not mqtt_connected:
-            pub_mqtt_client.reconnect()
-            sub_mqtt_client.reconnect()
+    # Subscribe to any feeds
+    if feed_handlers:
+        logger.debug("I have feeds to subscribe to")
 
-        get_time()
-        get_date()
-        get_weather()
-        get_shared_calendar_events()
-        #    monitor_garage_notification()
+    # Start the client's network loop once, it runs for the life of the hub and handles reconnecting
+    start_mqtt_network_loop(mqtt_client)
+    start_metrics_server()
 
-    wanCheck_counter += 1
-    time.sleep(0.5)
+    logger.info("hello world, home hub is starting up!")
+    add_task("connections", check_connections, wan_check_wait, needs_wan=False, timeout=30)
+    add_task("time", get_time, 60, align=True)
+    add_task("date", get_date, 60, align=True)
+    add_task("weather", get_weather, weather_report_wait, jitter=30, timeout=60)
+    add_task("calendar", get_shared_calendar_events, calendar_report_wait, jitter=60)
+    add_task("calendar expiry", expire_calendar_events, 60, align=True)
 
+    asyncio.run(main())
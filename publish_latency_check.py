@@ -0,0 +1,39 @@
+# SPDX-License-Identifier: MIT
+import sys
+import time
+import pi_code
+
+# Check that the hub's publish latency histogram fills with paho's network thread running, including QoS 0
+# publishes the network thread sends and acknowledges before publish() has returned
+# Publishes QoS 0 and QoS 1 messages to a test feed and checks every one of them was counted and nothing
+# is left waiting for an acknowledgement
+# Run it from the home hub directory so .env is found
+# Usage: python publish_latency_check.py <test feed> [messages per QoS level]
+
+feed = sys.argv[1]
+messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+pi_code.mqtt_client = pi_code.connect_mqtt("latency-check")
+pi_code.start_mqtt_network_loop(pi_code.mqtt_client)
+give_up = time.monotonic() + 30
+while not pi_code.mqtt_client.is_connected():
+    if time.monotonic() > give_up:
+        sys.exit("could not connect to the MQTT broker")
+    time.sleep(0.1)
+
+for qos in (0, 1):
+    for count in range(messages):
+        if not pi_code.send_publish(feed, f"latency check {qos} {count}", qos=qos):
+            sys.exit(f"publish {count} at QoS {qos} was not accepted")
+
+# Give the QoS 1 acknowledgements time to arrive
+give_up = time.monotonic() + 10
+while pi_code.get_publish_latency_stats()["pending"] and time.monotonic() < give_up:
+    time.sleep(0.1)
+
+stats = pi_code.get_publish_latency_stats()
+print(f"counted={stats['count']} pending={stats['pending']} mean={stats['sum'] / max(stats['count'], 1):.1f}ms")
+print(f"buckets={stats['buckets']}")
+if stats["count"] != messages * 2 or stats["pending"]:
+    sys.exit(f"expected {messages * 2} publishes counted and none pending")
+print("publish latency histogram OK")